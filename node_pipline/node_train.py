@@ -10,9 +10,9 @@ import sys
 
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(project_root)
-from node_toolkit.node_net import MHDNet, HDNet
-from node_toolkit.node_dataset import NodeDataset, MinMaxNormalize, RandomRotate, RandomShift, RandomFlip, RandomZoom, OneHot, OrderedSampler, worker_init_fn
-from node_toolkit.node_utils import train, validate, CosineAnnealingLR, PolynomialLR, ReduceLROnPlateau
+from node_toolkit.node_net import MHDNet, HDNet, compile_edges, enable_checkpointing
+from node_toolkit.node_dataset import NodeDataset, MinMaxNormalize, RandomRotate, RandomShift, RandomFlip, RandomZoom, OneHot, OrderedSampler, MultiNodeDataset, worker_init_fn, list_data_dir
+from node_toolkit.node_utils import train, validate, append_jsonl, AsyncCheckpointSaver, CosineAnnealingLR, PolynomialLR, ReduceLROnPlateau
 from node_toolkit.node_results import (
     node_focal_loss, node_recall_metric, node_precision_metric, 
     node_f1_metric, node_accuracy_metric, node_specificity_metric
@@ -27,10 +27,14 @@ def main():
     运行带深度监督和统一标签处理的训练流水线的主函数。
     """
     seed = 42
-    torch.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
+    torch.manual_seed(seed)  # Also seeds every CUDA device (lazily, on first CUDA use)
     np.random.seed(seed)
 
+    # Input shapes are fixed, so let cuDNN autotune conv algorithms and allow TF32 on Ampere+
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")  # TF32 matmuls, also honoured by torch.compile/Inductor
+    torch.backends.cudnn.allow_tf32 = True
+
     # Data and save paths
     base_data_dir = r"/data/menghaoding/thu_xwh/TrainNiigzCsvData/Tr_fold1/"
     train_data_dir = os.path.join(base_data_dir, "train")
@@ -40,14 +44,24 @@ def main():
 
     # Hyperparameters
     batch_size = 8
+    accumulation_steps = 1  # Gradient accumulation steps (effective batch = batch_size * accumulation_steps)
     num_dimensions = 3
     num_epochs = 100
     learning_rate = 1e-3
     weight_decay = 1e-5
     validation_interval = 1
-    patience = 100
+    log_snapshot_interval = 25  # Epochs between full training_log.json snapshots
+    patience = max(20, num_epochs // 10)  # Epochs without a better save criterion before early stopping
     num_workers = 16
     scheduler_type = "poly"  # Options: "cosine", "poly", or "reduce_plateau"
+    precision = "fp16"  # Options: "fp32", "fp16", or "bf16"
+    compile_model = True  # Compile the model with torch.compile (PyTorch 2.0+)
+    compile_mode = "max-autotune"  # Options: "default", "reduce-overhead", or "max-autotune"
+    compile_scope = "model"  # Options: "model" (whole MHDNet), "edges" (each DNet separately, routing stays eager),
+                             # or "classifiers" (only classifier edges, always "reduce-overhead" CUDA graphs; compile_mode is ignored)
+    channels_last = True  # Use channels_last_3d memory format for Conv3d
+    gradient_checkpointing = False  # Recompute activations of k>1 conv edges during backward to save memory
+    cache_decoded = True  # Cache decoded NIfTI volumes as .npy under save_dir to skip gzip decoding after epoch 1
 
     # Save HDNet configurations
     save_hdnet = {
@@ -226,7 +240,7 @@ def main():
                 "convs": [torch.Size([4, 256, 1, 1, 1])],
                 "reqs": [True],
                 "norms": ["batch"],
-                "acts": ["softmax"],
+                "acts": [None],  # Logits; node_focal_loss applies log_softmax
                 "feature_size": (1, 1, 1),
                 "intp": "avg"
             }
@@ -246,7 +260,7 @@ def main():
                 "convs": [torch.Size([4, 128, 1, 1, 1])],
                 "reqs": [True],
                 "norms": ["batch"],
-                "acts": ["softmax"],
+                "acts": [None],  # Logits; node_focal_loss applies log_softmax
                 "feature_size": (1, 1, 1),
                 "intp": "avg"
             }
@@ -266,7 +280,7 @@ def main():
                 "convs": [torch.Size([4, 64, 1, 1, 1])],
                 "reqs": [True],
                 "norms": ["batch"],
-                "acts": ["softmax"],
+                "acts": [None],  # Logits; node_focal_loss applies log_softmax
                 "feature_size": (1, 1, 1),
                 "intp": "avg"
             }
@@ -286,7 +300,7 @@ def main():
                 "convs": [torch.Size([4, 32, 1, 1, 1])],
                 "reqs": [True],
                 "norms": ["batch"],
-                "acts": ["softmax"],
+                "acts": [None],  # Logits; node_focal_loss applies log_softmax
                 "feature_size": (1, 1, 1),
                 "intp": "avg"
             }
@@ -306,7 +320,7 @@ def main():
                 "convs": [torch.Size([4, 32, 1, 1, 1])],
                 "reqs": [True],
                 "norms": ["batch"],
-                "acts": ["softmax"],
+                "acts": [None],  # Logits; node_focal_loss applies log_softmax
                 "feature_size": (1, 1, 1),
                 "intp": "avg"
             }
@@ -349,6 +363,11 @@ def main():
         ("n120", "label_net", "n0"),
     ]
 
+    # Global node -> (sub_net_name, sub_node_id); the first mapping wins for shared global nodes
+    node_mapping_by_global = {}
+    for global_node, sub_net_name, sub_node_id in node_mapping:
+        node_mapping_by_global.setdefault(global_node, (sub_net_name, sub_node_id))
+
     # Sub-network configurations
     sub_networks_configs = {
         "unet1": (node_configs_unet1, hyperedge_configs_unet1),
@@ -408,14 +427,15 @@ def main():
         }
     }
 
-    invs = [1/(492+112),1/(912+226),1/(1770+530),1/(2066+460)]
-    invs_sum = sum(invs)
+    class_counts = np.array([492+112, 912+226, 1770+530, 2066+460], dtype=np.float64)
+    invs = 1.0 / class_counts
+    alpha = (invs / invs.sum()).tolist()  # Normalized class weights as a list so loss params stay JSON-serializable; get_alpha_tensor caches the device tensor
 
     # Task configuration with deep supervision
     task_configs = {
         "type_cls_n5": {
             "loss": [
-                {"fn": node_focal_loss, "origin_node": "n115", "target_node": "n120", "weight": 1.0, "params": {"alpha": [x / invs_sum for x in invs], "gamma": 0}},
+                {"fn": node_focal_loss, "origin_node": "n115", "target_node": "n120", "weight": 1.0, "params": {"alpha": alpha, "gamma": 0, "from_logits": True}},
             ],
             "metric": [
                 {"fn": node_recall_metric, "origin_node": "n115", "target_node": "n120", "params": {}},
@@ -427,7 +447,7 @@ def main():
         },
         "type_cls_n6": {
             "loss": [
-                {"fn": node_focal_loss, "origin_node": "n116", "target_node": "n120", "weight": 1.0, "params": {"alpha": [x / invs_sum for x in invs], "gamma": 0}},
+                {"fn": node_focal_loss, "origin_node": "n116", "target_node": "n120", "weight": 1.0, "params": {"alpha": alpha, "gamma": 0, "from_logits": True}},
             ],
             "metric": [
                 {"fn": node_recall_metric, "origin_node": "n116", "target_node": "n120", "params": {}},
@@ -439,7 +459,7 @@ def main():
         },
         "type_cls_n7": {
             "loss": [
-                {"fn": node_focal_loss, "origin_node": "n117", "target_node": "n120", "weight": 1.0, "params": {"alpha": [x / invs_sum for x in invs], "gamma": 0}},
+                {"fn": node_focal_loss, "origin_node": "n117", "target_node": "n120", "weight": 1.0, "params": {"alpha": alpha, "gamma": 0, "from_logits": True}},
             ],
             "metric": [
                 {"fn": node_recall_metric, "origin_node": "n117", "target_node": "n120", "params": {}},
@@ -451,7 +471,7 @@ def main():
         },
         "type_cls_n8": {
             "loss": [
-                {"fn": node_focal_loss, "origin_node": "n118", "target_node": "n120", "weight": 1.0, "params": {"alpha": [x / invs_sum for x in invs], "gamma": 0}},
+                {"fn": node_focal_loss, "origin_node": "n118", "target_node": "n120", "weight": 1.0, "params": {"alpha": alpha, "gamma": 0, "from_logits": True}},
             ],
             "metric": [
                 {"fn": node_recall_metric, "origin_node": "n118", "target_node": "n120", "params": {}},
@@ -463,7 +483,7 @@ def main():
         },
         "type_cls_n9": {
             "loss": [
-                {"fn": node_focal_loss, "origin_node": "n119", "target_node": "n120", "weight": 1.0, "params": {"alpha": [x / invs_sum for x in invs], "gamma": 0}},
+                {"fn": node_focal_loss, "origin_node": "n119", "target_node": "n120", "weight": 1.0, "params": {"alpha": alpha, "gamma": 0, "from_logits": True}},
             ],
             "metric": [
                 {"fn": node_recall_metric, "origin_node": "n119", "target_node": "n120", "params": {}},
@@ -476,14 +496,14 @@ def main():
     }
 
     # Collect case IDs for train and val
-    def get_case_ids(data_dir, filename):
-        all_files = sorted(os.listdir(data_dir))
-        case_ids = []
-        for file in all_files:
-            if file.startswith('case_') and file.endswith(filename):
-                case_id = file.split('_')[1]
-                case_ids.append(case_id)
-        return sorted(case_ids)
+    def get_filename_case_ids(data_dir, filenames):
+        # Single pass over the directory, bucketing 'case_<id>_<filename>' entries by filename
+        filename_case_ids = {filename: [] for filename in filenames}
+        for file in list_data_dir(data_dir):
+            parts = file.split('_', 2)
+            if len(parts) == 3 and parts[0] == 'case' and parts[2] in filename_case_ids:
+                filename_case_ids[parts[2]].append(parts[1])
+        return {filename: sorted(case_ids) for filename, case_ids in filename_case_ids.items()}
 
     # Initialize filename to nodes mapping
     filename_to_nodes = {}
@@ -493,15 +513,14 @@ def main():
         filename_to_nodes[filename].append(str(node))
 
     # Get case IDs for train and val directories
-    train_filename_case_ids = {}
-    val_filename_case_ids = {}
-    for filename in filename_to_nodes:
-        train_filename_case_ids[filename] = get_case_ids(train_data_dir, filename)
-        val_filename_case_ids[filename] = get_case_ids(val_data_dir, filename)
+    train_filename_case_ids = get_filename_case_ids(train_data_dir, filename_to_nodes)
+    val_filename_case_ids = get_filename_case_ids(val_data_dir, filename_to_nodes)
 
     # Take union of case IDs
-    train_case_ids = sorted(list(set().union(*[set(case_ids) for case_ids in train_filename_case_ids.values()])))
-    val_case_ids = sorted(list(set().union(*[set(case_ids) for case_ids in val_filename_case_ids.values()])))
+    train_case_id_set = set().union(*train_filename_case_ids.values())
+    train_case_ids = sorted(train_case_id_set)
+    val_case_id_set = set().union(*val_filename_case_ids.values())
+    val_case_ids = sorted(val_case_id_set)
 
     if not train_case_ids:
         raise ValueError("No case_ids found in train directory!")
@@ -510,13 +529,13 @@ def main():
 
     # Log missing files for each filename
     for filename, case_ids in train_filename_case_ids.items():
-        missing = [cid for cid in train_case_ids if cid not in case_ids]
+        missing = sorted(train_case_id_set.difference(case_ids))
         if missing:
-            logger.warning(f"Missing train files for filename {filename}: {sorted(list(missing))}")
+            logger.warning(f"Missing train files for filename {filename}: {missing}")
     for filename, case_ids in val_filename_case_ids.items():
-        missing = [cid for cid in val_case_ids if cid not in case_ids]
+        missing = sorted(val_case_id_set.difference(case_ids))
         if missing:
-            logger.warning(f"Missing val files for filename {filename}: {sorted(list(missing))}")
+            logger.warning(f"Missing val files for filename {filename}: {missing}")
 
     # Generate global random order for training
     train_case_id_order = np.random.permutation(train_case_ids).tolist()
@@ -540,66 +559,84 @@ def main():
     datasets_train = {}
     datasets_val = {}
     for node, filename in load_node:
-        target_shape = None
-        for global_node, sub_net_name, sub_node_id in node_mapping:
-            if global_node == node:
-                target_shape = sub_networks[sub_net_name].node_configs[sub_node_id]
-                break
-        if target_shape is None:
+        if node not in node_mapping_by_global:
             raise ValueError(f"Node {node} not found in node_mapping")
+        sub_net_name, sub_node_id = node_mapping_by_global[node]
+        target_shape = sub_networks[sub_net_name].node_configs[sub_node_id]
         datasets_train[node] = NodeDataset(
             train_data_dir, node, filename, target_shape, node_transforms["train"].get(node, []),
-            node_mapping=node_mapping, sub_networks=sub_networks,
             case_ids=train_case_ids, case_id_order=train_case_id_order,
-            num_dimensions=num_dimensions
+            num_dimensions=num_dimensions,
+            cache_dir=os.path.join(save_dir, "decoded_cache", "train") if cache_decoded else None
         )
         datasets_val[node] = NodeDataset(
             val_data_dir, node, filename, target_shape, node_transforms["validate"].get(node, []),
-            node_mapping=node_mapping, sub_networks=sub_networks,
             case_ids=val_case_ids,
             case_id_order=val_case_id_order,
-            num_dimensions=num_dimensions
+            num_dimensions=num_dimensions,
+            cache_dir=os.path.join(save_dir, "decoded_cache", "val") if cache_decoded else None
         )
 
-    # Validate case_id_order consistency across nodes
-    for node in datasets_train:
-        if datasets_train[node].case_ids != datasets_train[list(datasets_train.keys())[0]].case_ids:
-            logger.error(f"Case ID order inconsistent for node {node}")
-            raise ValueError(f"Case ID order inconsistent for node {node}")
-        if datasets_val[node].case_ids != datasets_val[list(datasets_val.keys())[0]].case_ids:
-            logger.error(f"Case ID order inconsistent for node {node} in validation")
-            raise ValueError(f"Case ID order inconsistent for node {node} in validation")
+    # Combine per-node datasets (also checks case_id_order consistency across nodes)
+    dataset_train = MultiNodeDataset(datasets_train, batch_size=batch_size, seed=seed)
+    dataset_val = MultiNodeDataset(datasets_val)
 
     # Create DataLoaders
-    dataloaders_train = {}
-    dataloaders_val = {}
-    for node in datasets_train:
-        train_indices = list(range(len(datasets_train[node])))
-        val_indices = list(range(len(datasets_val[node])))
-        dataloaders_train[node] = DataLoader(
-            datasets_train[node],
-            batch_size=batch_size,
-            sampler=OrderedSampler(train_indices, num_workers=num_workers),
-            num_workers=num_workers,
-            drop_last=True,
-            worker_init_fn=worker_init_fn
-        )
-        dataloaders_val[node] = DataLoader(
-            datasets_val[node],
-            batch_size=batch_size,
-            sampler=OrderedSampler(val_indices, num_workers=num_workers),
-            num_workers=num_workers,
-            drop_last=True,
-            worker_init_fn=worker_init_fn
-        )
+    train_indices = list(range(len(dataset_train)))
+    val_indices = list(range(len(dataset_val)))
+    dataloader_train = DataLoader(
+        dataset_train,
+        batch_size=batch_size,
+        sampler=OrderedSampler(train_indices, num_workers=num_workers),
+        num_workers=num_workers,
+        drop_last=True,
+        pin_memory=True,
+        prefetch_factor=4,
+        persistent_workers=True,  # The epoch reaches persistent workers through MultiNodeDataset's shared state
+        worker_init_fn=worker_init_fn,
+        generator=torch.Generator().manual_seed(seed)  # Reproducible per-worker base seeds
+    )
+    dataloader_val = DataLoader(
+        dataset_val,
+        batch_size=batch_size,
+        sampler=OrderedSampler(val_indices, num_workers=num_workers),
+        num_workers=num_workers,
+        drop_last=False,  # Evaluate every validation case
+        pin_memory=True,
+        prefetch_factor=4,
+        persistent_workers=True,  # Validation transforms are deterministic, so workers can be reused across epochs
+        worker_init_fn=worker_init_fn,
+        generator=torch.Generator().manual_seed(seed)  # Reproducible per-worker base seeds
+    )
 
     # Model
-    onnx_save_path = os.path.join(save_dir, "model_config_initial.onnx")
-    model = MHDNet(sub_networks, node_mapping, in_nodes, out_nodes, num_dimensions, onnx_save_path=onnx_save_path).to(device)
+    onnx_save_path = os.path.join(save_dir, "model_final.onnx")  # Written after training, holds the final-epoch weights
+    model = MHDNet(sub_networks, node_mapping, in_nodes, out_nodes, num_dimensions).to(device)
+    base_model = model  # Uncompiled reference, used for the ONNX export after training
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last_3d)
+    if gradient_checkpointing:
+        model = enable_checkpointing(model)
 
     # Optimizer with standard learning rate and weight decay
     optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
 
+    # Compile after the optimizer is built so parameter names keep the "sub_networks." prefix
+    if compile_model and hasattr(torch, "compile"):
+        # The classifier scope always captures CUDA graphs, whatever compile_mode is set to
+        effective_compile_mode = "reduce-overhead" if compile_scope == "classifiers" else compile_mode
+        if compile_scope == "edges":
+            model = compile_edges(model, mode=effective_compile_mode)
+        elif compile_scope == "classifiers":
+            classifier_names = [name for name in sub_networks if name.startswith("classifier")]
+            model = compile_edges(model, mode=effective_compile_mode, sub_network_names=classifier_names)
+        else:
+            model = torch.compile(model, mode=effective_compile_mode, fullgraph=False, dynamic=False)
+        logger.info(f"Compiled model with torch.compile (mode={effective_compile_mode}, scope={compile_scope})")
+
+    # Gradient scaler for FP16 mixed precision (pass-through for "fp32" and "bf16")
+    scaler = torch.cuda.amp.GradScaler(enabled=(precision == "fp16"))
+
     # Select scheduler
     if scheduler_type == "cosine":
         scheduler = CosineAnnealingLR(optimizer, T_max=num_epochs, eta_min=0)
@@ -623,23 +660,20 @@ def main():
     else:
         raise ValueError("save_mode must be 'min' or 'max'")
     log = {"epochs": []}
+    log_save_path = os.path.join(save_dir, "training_log.json")
+    epoch_log_path = os.path.join(save_dir, "training_log.jsonl")
+    with open(epoch_log_path, "w"):
+        pass  # Start a fresh per-epoch log
+    checkpoint_saver = AsyncCheckpointSaver()  # Writes best weights in the background
 
     for epoch in range(num_epochs):
-        epoch_seed = seed + epoch
-        np.random.seed(epoch_seed)
-        batch_seeds = np.random.randint(0, 1000000, size=len(dataloaders_train[list(dataloaders_train.keys())[0]]))
-        logger.info(f"Epoch {epoch + 1}: Generated {len(batch_seeds)} batch seeds")
-
-        for batch_idx in range(len(dataloaders_train[list(dataloaders_train.keys())[0]])):
-            batch_seed = int(batch_seeds[batch_idx])
-            logger.debug(f"Batch {batch_idx}, Seed {batch_seed}")
-            for node in datasets_train:
-                datasets_train[node].set_batch_seed(batch_seed)
-            for node in datasets_val:
-                datasets_val[node].set_batch_seed(batch_seed)
+        # Per-batch augmentation seeds are derived inside the dataset from (seed, epoch, batch index)
+        dataset_train.set_epoch(epoch)
 
         train_loss, train_task_losses, train_task_metrics = train(
-            model, dataloaders_train, optimizer, task_configs, out_nodes, epoch, num_epochs, debug=True
+            model, dataloader_train, optimizer, task_configs, out_nodes, epoch, num_epochs, debug=True,
+            scaler=scaler, precision=precision, channels_last=channels_last,
+            accumulation_steps=accumulation_steps
         )
 
         # Get current learning rate
@@ -654,7 +688,8 @@ def main():
 
         if (epoch + 1) % validation_interval == 0:
             val_loss, val_task_losses, val_task_metrics = validate(
-                model, dataloaders_val, task_configs, out_nodes, epoch, num_epochs, debug=True
+                model, dataloader_val, task_configs, out_nodes, epoch, num_epochs, debug=True,
+                precision=precision, channels_last=channels_last
             )
 
             # Calculate save criterion
@@ -679,31 +714,52 @@ def main():
             if should_save:
                 best_save_criterion = save_criterion
                 epochs_no_improve = 0
-                # Save HDNet weights
-                for net_name, save_path in save_hdnet.items():
-                    if net_name in sub_networks:
-                        torch.save(sub_networks[net_name].state_dict(), save_path)
-                        logger.info(f"Saved {net_name} weights to {save_path}")
+                # Save HDNet weights (one background job for all sub-networks)
+                checkpoint_saver.save_all({
+                    save_path: sub_networks[net_name].state_dict()
+                    for net_name, save_path in save_hdnet.items() if net_name in sub_networks
+                })
+                logger.info(f"Queued weights for saving: {[name for name in save_hdnet if name in sub_networks]}")
                 logger.info(f"New best save criterion: {save_criterion:.4f}")
             else:
                 epochs_no_improve += validation_interval
-                if epochs_no_improve >= patience:
-                    logger.info(f"Early stopping at epoch {epoch + 1}")
-                    break
 
             # Update learning rate for ReduceLROnPlateau
             if scheduler_type == "reduce_plateau":
                 scheduler.step(val_loss)
-            else:
-                scheduler.step()
+
+        # Epoch-based schedulers step every epoch, not only on validation epochs
+        if scheduler_type != "reduce_plateau":
+            scheduler.step()
 
         log["epochs"].append(epoch_log)
-        log_save_path = os.path.join(save_dir, "training_log.json")
-        with open(log_save_path, "w") as f:
-            json.dump(log, f, indent=4)
-        logger.info(f"Training log updated at {log_save_path}")
+        append_jsonl(epoch_log_path, epoch_log)
+        if (epoch + 1) % log_snapshot_interval == 0:
+            with open(log_save_path, "w") as f:
+                json.dump(log, f, indent=4)
+            logger.info(f"Training log snapshot saved to {log_save_path}")
+
+        # Stop after the epoch has been logged
+        if epochs_no_improve >= patience:
+            logger.info(f"Early stopping at epoch {epoch + 1}")
+            break
+
+    # Final full snapshot, also written after early stopping
+    with open(log_save_path, "w") as f:
+        json.dump(log, f, indent=4)
+    logger.info(f"Training log saved to {log_save_path}")
+    checkpoint_saver.close()
+
+    # Export the graph for inspection once training is done, so tracing does not delay the first epoch
+    try:
+        base_model.export_onnx(onnx_save_path)
+    except Exception as e:
+        logger.warning(f"ONNX export to {onnx_save_path} failed: {e}")
 
 if __name__ == "__main__":
+    # Let the caching allocator grow segments in place instead of fragmenting across epochs;
+    # must be set before the first CUDA call below
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
     # Specify using the third GPU
     device_id = 2  # Index of the third GPU (starting from 0)
     torch.cuda.set_device(device_id)
@@ -8,8 +8,8 @@ import sys
 
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(project_root)
-from node_toolkit.node_net import MHDNet, HDNet
-from node_toolkit.node_dataset import NodeDataset, OneHot, OrderedSampler, worker_init_fn
+from node_toolkit.node_net import MHDNet, HDNet, fuse_conv_bn
+from node_toolkit.node_dataset import NodeDataset, OneHot, OrderedSampler, MultiNodeDataset, worker_init_fn, list_data_dir
 from node_toolkit.node_utils import test
 
 logging.basicConfig(level=logging.INFO)
@@ -21,10 +21,14 @@ def main():
     运行更新后的 MHD_Nodet 项目测试流水线的主函数。
     """
     seed = 42
-    torch.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
+    torch.manual_seed(seed)  # Also seeds every CUDA device (lazily, on first CUDA use)
     np.random.seed(seed)
 
+    # Input shapes are fixed, so let cuDNN autotune conv algorithms and allow TF32 on Ampere+
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")  # TF32 matmuls, also honoured by torch.compile/Inductor
+    torch.backends.cudnn.allow_tf32 = True
+
     # Data and model paths
     base_data_dir = r"C:\Users\PC\PycharmProjects\thu_xwh\Val_Data"
     test_data_dir = os.path.join(base_data_dir, "scratch_imagesTs")
@@ -51,7 +55,9 @@ def main():
     # Hyperparameters
     batch_size = 16
     num_dimensions = 3
-    num_workers = 0
+    num_workers = 4
+    precision = "fp16"  # Options: "fp32", "fp16", or "bf16"
+    channels_last = True  # Use channels_last_3d memory format for Conv3d
 
     # UNet1 configuration (5-channel input, no dropout)
     node_configs_unet1 = {
@@ -916,6 +922,11 @@ def main():
         ("n150", "label_net", "n0"),
     ]
 
+    # Global node -> (sub_net_name, sub_node_id); the first mapping wins for shared global nodes
+    node_mapping_by_global = {}
+    for global_node, sub_net_name, sub_node_id in node_mapping:
+        node_mapping_by_global.setdefault(global_node, (sub_net_name, sub_node_id))
+
     # Sub-network configurations
     sub_networks_configs = {
         "unet1": (node_configs_unet1, hyperedge_configs_unet1),
@@ -943,13 +954,14 @@ def main():
     # Load pretrained weights for specified HDNets
     for net_name, weight_path in load_hdnet.items():
         if net_name in sub_networks and os.path.exists(weight_path):
-            state_dict = torch.load(weight_path, map_location=device)
+            # Memory-map the checkpoint on CPU and adopt its tensors directly; the model is moved to the device afterwards
+            state_dict = torch.load(weight_path, map_location="cpu", mmap=True, weights_only=True)
             try:
-                sub_networks[net_name].load_state_dict(state_dict, strict=True)
+                sub_networks[net_name].load_state_dict(state_dict, strict=True, assign=True)
                 logger.info(f"Loaded pretrained weights for {net_name} from {weight_path} with full matching")
             except RuntimeError as e:
                 logger.warning(f"Full matching failed for {net_name}: {e}. Attempting partial matching.")
-                sub_networks[net_name].load_state_dict(state_dict, strict=False)
+                sub_networks[net_name].load_state_dict(state_dict, strict=False, assign=True)
                 logger.info(f"Loaded pretrained weights for {net_name} from {weight_path} with partial matching")
         else:
             logger.warning(f"Could not load weights for {net_name}: {weight_path} does not exist")
@@ -993,14 +1005,14 @@ def main():
     }
 
     # Collect case IDs for test
-    def get_case_ids(data_dir, filename):
-        all_files = sorted(os.listdir(data_dir))
-        case_ids = []
-        for file in all_files:
-            if file.startswith('case_') and file.endswith(filename):
-                case_id = file.split('_')[1]
-                case_ids.append(case_id)
-        return sorted(case_ids)
+    def get_filename_case_ids(data_dir, filenames):
+        # Single pass over the directory, bucketing 'case_<id>_<filename>' entries by filename
+        filename_case_ids = {filename: [] for filename in filenames}
+        for file in list_data_dir(data_dir):
+            parts = file.split('_', 2)
+            if len(parts) == 3 and parts[0] == 'case' and parts[2] in filename_case_ids:
+                filename_case_ids[parts[2]].append(parts[1])
+        return {filename: sorted(case_ids) for filename, case_ids in filename_case_ids.items()}
 
     # Initialize filename to nodes mapping
     filename_to_nodes = {}
@@ -1010,21 +1022,20 @@ def main():
         filename_to_nodes[filename].append(str(node))
 
     # Get case IDs for test directory
-    test_filename_case_ids = {}
-    for filename in filename_to_nodes:
-        test_filename_case_ids[filename] = get_case_ids(test_data_dir, filename)
+    test_filename_case_ids = get_filename_case_ids(test_data_dir, filename_to_nodes)
 
     # Take union of case IDs
-    test_case_ids = sorted(list(set().union(*[set(case_ids) for case_ids in test_filename_case_ids.values()])))
+    test_case_id_set = set().union(*test_filename_case_ids.values())
+    test_case_ids = sorted(test_case_id_set)
 
     if not test_case_ids:
         raise ValueError("No case_ids found in test directory!")
 
     # Log missing files for each filename
     for filename, case_ids in test_filename_case_ids.items():
-        missing = [cid for cid in test_case_ids if cid not in case_ids]
+        missing = sorted(test_case_id_set.difference(case_ids))
         if missing:
-            logger.warning(f"Missing test files for filename {filename}: {sorted(list(missing))}")
+            logger.warning(f"Missing test files for filename {filename}: {missing}")
 
     # Use original order for testing
     test_case_id_order = test_case_ids
@@ -1032,45 +1043,46 @@ def main():
     # Create datasets
     datasets_test = {}
     for node, filename in load_node:
-        target_shape = None
-        for global_node, sub_net_name, sub_node_id in node_mapping:
-            if global_node == node:
-                target_shape = sub_networks[sub_net_name].node_configs[sub_node_id]
-                break
-        if target_shape is None:
+        if node not in node_mapping_by_global:
             raise ValueError(f"Node {node} not found in node_mapping")
+        sub_net_name, sub_node_id = node_mapping_by_global[node]
+        target_shape = sub_networks[sub_net_name].node_configs[sub_node_id]
         datasets_test[node] = NodeDataset(
             test_data_dir, node, filename, target_shape, node_transforms["test"].get(node, []),
-            node_mapping=node_mapping, sub_networks=sub_networks,
             case_ids=test_case_ids, case_id_order=test_case_id_order,
             num_dimensions=num_dimensions
         )
 
-    # Validate case_id_order consistency across nodes
-    for node in datasets_test:
-        if datasets_test[node].case_ids != datasets_test[list(datasets_test.keys())[0]].case_ids:
-            raise ValueError(f"Case ID order inconsistent for node {node} in test")
+    # Combine per-node datasets (also checks case_id_order consistency across nodes)
+    dataset_test = MultiNodeDataset(datasets_test)
 
-    # Create DataLoaders
-    dataloaders_test = {}
-    for node in datasets_test:
-        test_indices = list(range(len(datasets_test[node])))
-        dataloaders_test[node] = DataLoader(
-            datasets_test[node],
-            batch_size=batch_size,
-            sampler=OrderedSampler(test_indices, num_workers),
-            num_workers=num_workers,
-            drop_last=False,
-            worker_init_fn=worker_init_fn
-        )
+    # Create DataLoader
+    test_indices = list(range(len(dataset_test)))
+    dataloader_test = DataLoader(
+        dataset_test,
+        batch_size=batch_size,
+        sampler=OrderedSampler(test_indices, num_workers),
+        num_workers=num_workers,
+        drop_last=False,
+        pin_memory=True,
+        prefetch_factor=2,
+        worker_init_fn=worker_init_fn,
+        generator=torch.Generator().manual_seed(seed)  # Reproducible per-worker base seeds
+    )
 
     # Load model
     onnx_save_path = os.path.join(save_dir, "model_config_initial.onnx")
+    if os.path.exists(onnx_save_path):
+        onnx_save_path = None  # Already exported by an earlier test run; skip re-tracing before inference
     model = MHDNet(sub_networks, node_mapping, in_nodes, out_nodes, num_dimensions, onnx_save_path=onnx_save_path).to(device)
+    model = fuse_conv_bn(model)  # Fold BatchNorm into the preceding convs for inference
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last_3d)
 
     # Run test
     test(
-        model, dataloaders_test, out_nodes, save_node, test_data_dir, debug=True
+        model, dataloader_test, out_nodes, save_node, test_data_dir, debug=True,
+        channels_last=channels_last, precision=precision
     )
     logger.info("Testing completed. Predictions saved to test directory.")
 
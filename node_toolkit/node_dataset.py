@@ -3,12 +3,14 @@ MHD_Nodet Project - Dataset Module
 ==================================
 This module provides data loading and preprocessing utilities for the MHD_Nodet project, designed for medical imaging data.
 - Includes dataset class (NodeDataset) for loading NIfTI and CSV files with customizable transformations.
+- Includes MultiNodeDataset to combine per-node datasets into a single dataset yielding {node: tensor} samples.
 - Supports batch-consistent data augmentations (rotation, flip, shift, zoom) and normalization (Min-Max, Z-Score).
 - Includes OrderedSampler for consistent data ordering and worker_init_fn for reproducible worker initialization.
 
 项目：MHD_Nodet - 数据集模块
 本模块为 MHD_Nodet 项目提供数据加载和预处理工具，专为医学影像数据设计。
 - 包含 NodeDataset 类，用于加载 NIfTI 和 CSV 文件，支持自定义变换。
+- 包含 MultiNodeDataset 类，将各节点数据集合并为单一数据集，返回 {节点: 张量} 样本。
 - 支持批次一致的数据增强（旋转、翻转、平移、缩放）和归一化（Min-Max、Z-Score）。
 - 包含 OrderedSampler 类以确保数据顺序一致，以及 worker_init_fn 以确保可重现的worker初始化。
 
@@ -18,18 +20,27 @@ Institution: Tsinghua University (清华大学)
 """
 
 import os
+import functools
 import torch
 from torch.utils.data import Dataset, Sampler
 import numpy as np
 import pandas as pd
 import nibabel as nib
 import torch.nn.functional as F
-from scipy.ndimage import rotate, zoom
+from scipy.ndimage import rotate, zoom, affine_transform
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=None)
+def list_data_dir(data_dir):
+    """
+    List a data directory once per process; every NodeDataset built on the same directory reuses the listing.
+    每个进程只列出一次数据目录，基于同一目录构建的所有 NodeDataset 复用该列表。
+    """
+    return frozenset(os.listdir(data_dir))
+
 class OrderedSampler(Sampler):
     """
     Custom sampler to enforce consistent order of indices across workers.
@@ -130,13 +141,11 @@ class OneHot:
         img = img.astype(np.float32)
         img = np.round(img).astype(np.int64)
         img = np.clip(img, 0, self.num_classes - 1)
-        img_tensor = torch.tensor(img, dtype=torch.int64)
-        if img_tensor.ndim > 1:
-            img_tensor = img_tensor.squeeze()
-        img_tensor = F.one_hot(img_tensor, num_classes=self.num_classes)
-        permute_order = [-1] + list(range(img_tensor.ndim - 1))
-        img_tensor = img_tensor.permute(*permute_order).float()
-        return img_tensor.numpy().astype(np.float32)
+        if img.ndim > 1:
+            img = img.squeeze()
+        # Index an identity matrix instead of round-tripping through torch in the worker
+        img = np.eye(self.num_classes, dtype=np.float32)[img]
+        return np.ascontiguousarray(np.moveaxis(img, -1, 0))
 
     def reset(self):
         pass
@@ -178,7 +187,7 @@ class RandomFlip:
 
         # Decide whether to apply flip and which axis to flip
         if self.flip_axis is None:
-            np.random.seed(self.batch_seed)
+            rng = np.random.default_rng(self.batch_seed)
             # If axes is None, consider all spatial axes
             if self.axes is None:
                 self.axes = list(range(num_dims))
@@ -186,9 +195,9 @@ class RandomFlip:
             if not all(0 <= ax < num_dims for ax in self.axes):
                 raise ValueError(f"Invalid axes {self.axes} for {num_dims}-dimensional data")
             # Decide whether to apply flip
-            if np.random.rand() < self.p:
+            if rng.random() < self.p:
                 # Randomly select one axis to flip
-                self.flip_axis = np.random.choice(self.axes)
+                self.flip_axis = rng.choice(self.axes)
                 logger.debug(f"RandomFlip: Selected axis {self.flip_axis} for flipping")
             else:
                 self.flip_axis = None
@@ -207,7 +216,9 @@ class RandomFlip:
 class RandomRotate:
     """
     Random rotation augmentation with batch-consistent randomness, supporting 2D or 3D data.
+    For 3D data the three plane rotations are composed into one matrix and applied in a single affine pass.
     带批次一致随机性的随机旋转增强，支持 2D 或 3D 数据。
+    对 3D 数据，三个平面旋转合成为一个矩阵，只需一次仿射变换。
     """
     def __init__(self, max_angle=5, p=0.5):
         """
@@ -237,18 +248,17 @@ class RandomRotate:
         order = 0 if is_integer else 1
         num_dims = len(img.shape) - 1
 
-        # Decide whether to apply rotation
-        np.random.seed(self.batch_seed)
-        if np.random.rand() >= self.p:
+        # Decide whether to apply rotation (local generator, so the global NumPy RNG is left untouched)
+        rng = np.random.default_rng(self.batch_seed)
+        if rng.random() >= self.p:
             logger.debug("RandomRotate: No rotation applied")
             return img.astype(input_dtype)
 
         if self.angles is None:
-            np.random.seed(self.batch_seed)
             if num_dims == 2:
-                self.angles = [np.random.uniform(-self.max_angle, self.max_angle)]
+                self.angles = [rng.uniform(-self.max_angle, self.max_angle)]
             elif num_dims == 3:
-                self.angles = np.random.uniform(-self.max_angle, self.max_angle, 3)
+                self.angles = rng.uniform(-self.max_angle, self.max_angle, 3)
             else:
                 raise ValueError(f"Unsupported number of dimensions: {num_dims}")
             logger.debug(f"RandomRotate: Angles {self.angles}")
@@ -256,14 +266,31 @@ class RandomRotate:
         if num_dims == 2:
             img = rotate(img, angle=self.angles[0], axes=(1, 2), reshape=False, order=order, mode='nearest')
         elif num_dims == 3:
-            for i, angle in enumerate(self.angles):
-                axes = [(j % num_dims, (j + 1) % num_dims) for j in range(i, i + 2)][0]
-                axes = (axes[0] + 1, axes[1] + 1)
-                img = rotate(img, angle=angle, axes=axes, reshape=False, order=order, mode='nearest')
+            # Same rotations as rotate() in the (0, 1), (1, 2), (2, 0) spatial planes, composed about the volume center
+            matrix = self._rotation_matrix_3d(self.angles)
+            center = (np.array(img.shape[1:]) - 1) / 2.0
+            offset = center - matrix @ center
+            img = np.stack([
+                affine_transform(img[c], matrix, offset=offset, order=order, mode='nearest')
+                for c in range(img.shape[0])
+            ])
 
         img = img.astype(input_dtype)
         return img
 
+    @staticmethod
+    def _rotation_matrix_3d(angles):
+        # Output-to-input coordinate map of rotating in plane (0, 1), then (1, 2), then (2, 0),
+        # using scipy.ndimage.rotate's convention (plane axes sorted, matrix [[c, s], [-s, c]])
+        matrix = np.eye(3)
+        for i, angle in enumerate(angles):
+            a, b = sorted((i % 3, (i + 1) % 3))
+            c, s = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+            plane = np.eye(3)
+            plane[a, a], plane[a, b], plane[b, a], plane[b, b] = c, s, -s, c
+            matrix = matrix @ plane
+        return matrix
+
     def reset(self):
         self.angles = None
 
@@ -299,14 +326,13 @@ class RandomShift:
         num_dims = len(img.shape) - 1
 
         # Decide whether to apply shift
-        np.random.seed(self.batch_seed)
-        if np.random.rand() >= self.p:
+        rng = np.random.default_rng(self.batch_seed)
+        if rng.random() >= self.p:
             logger.debug("RandomShift: No shift applied")
             return img.astype(input_dtype)
 
         if self.shifts is None:
-            np.random.seed(self.batch_seed)
-            self.shifts = np.random.randint(-self.max_shift, self.max_shift, num_dims)
+            self.shifts = rng.integers(-self.max_shift, self.max_shift, num_dims)
             logger.debug(f"RandomShift: Shifts {self.shifts}")
 
         for axis, shift in enumerate(self.shifts):
@@ -351,14 +377,13 @@ class RandomZoom:
         num_dims = len(img.shape) - 1
 
         # Decide whether to apply zoom
-        np.random.seed(self.batch_seed)
-        if np.random.rand() >= self.p:
+        rng = np.random.default_rng(self.batch_seed)
+        if rng.random() >= self.p:
             logger.debug("RandomZoom: No zoom applied")
             return img.astype(input_dtype)
 
         if self.zoom_factor is None:
-            np.random.seed(self.batch_seed)
-            self.zoom_factor = np.random.uniform(self.zoom_range[0], self.zoom_range[1])
+            self.zoom_factor = rng.uniform(self.zoom_range[0], self.zoom_range[1])
             logger.debug(f"RandomZoom: Seed {self.batch_seed}, Zoom factor {self.zoom_factor}")
 
         zoomed = np.zeros_like(img, dtype=np.float32)
@@ -411,8 +436,7 @@ class RandomDrop:
     def __call__(self, img):
         input_dtype = img.dtype
         if self.drop is None:
-            np.random.seed(self.batch_seed)
-            self.drop = np.random.rand() < self.p
+            self.drop = np.random.default_rng(self.batch_seed).random() < self.p
             logger.debug(f"RandomDrop: Drop decision {self.drop}")
 
         if self.drop:
@@ -429,19 +453,20 @@ class NodeDataset(Dataset):
     用于加载医学影像数据并应用变换的数据集类。
     处理缺失文件，通过生成占位特征图并记录警告。
     """
-    def __init__(self, data_dir, node_id, filename, target_shape, transforms=None, node_mapping=None, sub_networks=None, case_ids=None, case_id_order=None, num_dimensions=3, batch_seed=None):
+    def __init__(self, data_dir, node_id, filename, target_shape, transforms=None, case_ids=None, case_id_order=None, num_dimensions=3, batch_seed=None, cache_dir=None):
         self.data_dir = data_dir
         self.node_id = str(node_id)
         self.filename = filename
         self.target_shape = target_shape
         self.transforms = transforms or []
-        self.node_mapping = node_mapping
-        self.sub_networks = sub_networks
         self.case_id_order = case_id_order
         self.num_dimensions = num_dimensions
         self.batch_seed = batch_seed
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
 
-        all_files = sorted(os.listdir(data_dir))
+        all_files = list_data_dir(data_dir)
         self.file_ext = '.' + filename.split('.', 1)[1] if '.' in filename else ''
         
         # Accept all provided case_ids without checking for file existence
@@ -456,7 +481,8 @@ class NodeDataset(Dataset):
                 logger.warning(f"Missing files for node {self.node_id}, filename {self.filename}: {missing_files}")
 
         if self.case_id_order is not None:
-            invalid_ids = [cid for cid in self.case_id_order if cid not in self.case_ids]
+            case_id_set = set(self.case_ids)
+            invalid_ids = [cid for cid in self.case_id_order if cid not in case_id_set]
             if invalid_ids:
                 raise ValueError(f"Invalid case IDs in case_id_order: {invalid_ids}")
             self.case_ids = self.case_id_order
@@ -477,6 +503,28 @@ class NodeDataset(Dataset):
     def __len__(self):
         return len(self.case_ids)
 
+    def _load_nifti(self, data_path, case_id):
+        """
+        Load a NIfTI volume as float32, reusing a decoded .npy copy in cache_dir to skip repeated gzip decoding.
+        The cache file is rebuilt when the source file is newer, and written atomically so concurrent workers are safe.
+        Cache hits are memory-mapped read-only, so the first transform's copy reads straight from the page cache.
+        以 float32 加载 NIfTI 数据，若 cache_dir 中有解码后的 .npy 副本则直接复用，避免重复 gzip 解压。
+        源文件更新时重建缓存；缓存以原子方式写入，多个 worker 并发时安全。
+        命中缓存时以只读方式内存映射，第一个变换的复制直接从页缓存读取。
+        """
+        cache_path = None
+        if self.cache_dir is not None:
+            cache_path = os.path.join(self.cache_dir, f'case_{case_id}_{self.filename}.npy')
+            if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(data_path):
+                return np.load(cache_path, mmap_mode='r')
+        data = nib.load(data_path).get_fdata(dtype=np.float32)  # Avoid the default float64 intermediate
+        if cache_path is not None:
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, data)
+            os.replace(tmp_path, cache_path)
+        return data
+
     def __getitem__(self, idx):
         case_id = self.case_ids[idx]
         data_path = os.path.join(self.data_dir, f'case_{case_id}_{self.filename}')
@@ -491,7 +539,7 @@ class NodeDataset(Dataset):
                 raise ValueError(f"Unsupported file extension: {self.file_ext}")
         else:
             if self.file_ext == '.nii.gz':
-                data = nib.load(data_path).get_fdata()
+                data = self._load_nifti(data_path, case_id)
                 data_array = np.asarray(data, dtype=np.float32)
                 data_array = np.squeeze(data_array)
                 if data_array.ndim == self.num_dimensions:
@@ -510,7 +558,10 @@ class NodeDataset(Dataset):
         for t in self.transforms:
             data_array = t(data_array)
 
-        data_tensor = torch.tensor(data_array, dtype=torch.float32)
+        data_array = np.ascontiguousarray(data_array, dtype=np.float32)
+        if not data_array.flags.writeable:
+            data_array = data_array.copy()  # Memory-mapped cache hit that no transform copied
+        data_tensor = torch.from_numpy(data_array)
 
         current_shape = data_tensor.shape
         target_channels = self.target_shape[0]
@@ -555,3 +606,77 @@ class NodeDataset(Dataset):
             raise ValueError(f"Data tensor shape {data_tensor.shape} does not match target shape {self.target_shape} for node {self.node_id}")
 
         return data_tensor
+
+
+class MultiNodeDataset(Dataset):
+    """
+    Dataset combining per-node NodeDatasets that share the same case_ids order.
+    Each sample is a {node: tensor} dict, so a single DataLoader (with the default collate)
+    yields one batch per step for all nodes instead of one DataLoader per node.
+    With batch_size set, each sample derives its batch seed from (seed, epoch, idx // batch_size), so every batch
+    gets its own augmentation parameters, shared by all of its samples and nodes; call set_epoch once per epoch.
+    The epoch and any explicit batch seed live in shared memory, so persistent DataLoader workers see updates.
+    合并共享相同 case_ids 顺序的各节点 NodeDataset 的数据集。
+    每个样本为 {节点: 张量} 字典，单个 DataLoader（使用默认 collate）即可在每步为所有节点生成批次，
+    无需为每个节点创建一个 DataLoader。
+    设置 batch_size 后，每个样本根据 (seed, epoch, idx // batch_size) 推导批次种子，使每个批次拥有独立的增强参数，
+    并在该批次的所有样本和节点间保持一致；每个 epoch 调用一次 set_epoch 即可。
+    epoch 和显式设置的批次种子保存在共享内存中，常驻（persistent）的 DataLoader worker 也能获取更新。
+    """
+    def __init__(self, datasets, batch_size=None, seed=0):
+        if not datasets:
+            raise ValueError("MultiNodeDataset requires at least one node dataset")
+        self.datasets = datasets
+        self.case_ids = next(iter(datasets.values())).case_ids
+        for node, dataset in datasets.items():
+            if dataset.case_ids != self.case_ids:
+                logger.error(f"Case ID order inconsistent for node {node}")
+                raise ValueError(f"Case ID order inconsistent for node {node}")
+        self.batch_size = batch_size
+        self.seed = seed
+        self.shared_seed = torch.full((1,), -1, dtype=torch.int64).share_memory_()
+        self.shared_epoch = torch.full((1,), -1, dtype=torch.int64).share_memory_()
+        self.applied_seed = None
+
+    def set_epoch(self, epoch):
+        """
+        Set the current epoch, from which per-batch seeds are derived.
+        设置当前 epoch，用于推导每个批次的种子。
+        """
+        if self.batch_size is None:
+            raise ValueError("set_epoch requires MultiNodeDataset to be built with batch_size")
+        self.shared_epoch[0] = epoch
+
+    def set_batch_seed(self, seed):
+        """
+        Set the batch seed on every node dataset and publish it to DataLoader workers.
+        为每个节点数据集设置批次种子，并同步给 DataLoader worker。
+        """
+        self.shared_seed[0] = seed
+        self._apply_batch_seed(seed)
+
+    def _apply_batch_seed(self, seed):
+        for dataset in self.datasets.values():
+            dataset.set_batch_seed(seed)
+        self.applied_seed = seed
+
+    def batch_seed_for(self, idx):
+        """
+        Deterministic batch seed for sample idx in the current epoch.
+        当前 epoch 中样本 idx 对应的确定性批次种子。
+        """
+        epoch = int(self.shared_epoch[0])
+        return int(np.random.SeedSequence([self.seed, epoch, idx // self.batch_size]).generate_state(1)[0])
+
+    def __len__(self):
+        return len(self.case_ids)
+
+    def __getitem__(self, idx):
+        # Worker processes hold their own dataset copy, so the seed is resolved here rather than broadcast
+        if self.batch_size is not None and int(self.shared_epoch[0]) >= 0:
+            seed = self.batch_seed_for(idx)
+        else:
+            seed = int(self.shared_seed[0])
+        if seed >= 0 and seed != self.applied_seed:
+            self._apply_batch_seed(seed)
+        return {node: dataset[idx] for node, dataset in self.datasets.items()}
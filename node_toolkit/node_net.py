@@ -20,6 +20,8 @@ Institution: Tsinghua University (清华大学)
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
 from collections import defaultdict, deque
 from typing import List, Dict, Tuple, Optional, Union
 import warnings
@@ -31,16 +33,19 @@ def validate_lengths(*args, names: List[str]):
         raise ValueError(f"参数长度不一致: {dict(zip(names, lengths))}")
 
 class DNet(nn.Module):
-    """动态网络，支持多层卷积、归一化和激活，保持空间形状不变。
+    """动态网络，支持多层卷积、归一化和激活，默认保持空间形状不变（设置 strides 时按步长下采样）。
 
     Args:
         in_channels (int): 输入通道数。
         out_channels (int): 输出通道数。
         num_dimensions (int): 维度（1D、2D 或 3D）。
-        convs (List[Union[torch.Size, torch.Tensor]]): 每层卷积配置，格式为 torch.Size([out_channels, in_channels, kernel_size...]) 或 torch.Tensor。
+        convs (List[Union[torch.Size, Tuple[int, ...], torch.Tensor]]): 每层卷积配置，格式为 torch.Size([out_channels, in_channels, kernel_size...])、等价的整数元组/列表或 torch.Tensor。
         reqs (Optional[List[bool]]): 每层卷积是否可学习，True 表示可学习，False 表示不可学习。
         norms (Optional[List[Optional[str]]]): 每层归一化类型，None 表示无归一化。
         acts (Optional[List[Optional[str]]]): 每层激活函数类型，None 表示无激活。
+        strides (Optional[List[int]]): 每层卷积步长，None 表示全部为 1；例如首层步长 2 可代替 "max" 池化下采样。
+        identity (bool): 为 True 时，不可学习、步长为 1 的 1x1 恒等卷积核（如 torch.eye 构造）以 Identity 代替，不执行卷积；
+            该层不再有 weight，state_dict 随之变化，因此需显式开启（超边 params 中的 "identity": True）。默认 False。
     """
     NORM_TYPES = {
         "instance": lambda dim, ch: getattr(nn, f"InstanceNorm{dim}d")(ch),
@@ -61,10 +66,12 @@ class DNet(nn.Module):
         in_channels: int,
         out_channels: int,
         num_dimensions: int,
-        convs: List[Union[torch.Size, torch.Tensor]],
+        convs: List[Union[torch.Size, Tuple[int, ...], torch.Tensor]],
         reqs: Optional[List[bool]] = None,
         norms: Optional[List[Optional[str]]] = None,
         acts: Optional[List[Optional[str]]] = None,
+        strides: Optional[List[int]] = None,
+        identity: bool = False,
     ):
         super().__init__()
         self.num_dimensions = num_dimensions
@@ -77,12 +84,13 @@ class DNet(nn.Module):
         norms = norms if norms is not None else [None] * len(convs)
         acts = acts if acts is not None else [None] * len(convs)
         reqs = reqs if reqs is not None else [True] * len(convs)
+        strides = strides if strides is not None else [1] * len(convs)
 
-        validate_lengths(convs, norms, acts, reqs, names=["convs", "norms", "acts", "reqs"])
+        validate_lengths(convs, norms, acts, reqs, strides, names=["convs", "norms", "acts", "reqs", "strides"])
 
         current_channels = in_channels
-        for i, (conv_config, req, norm_type, act_type) in enumerate(zip(convs, reqs, norms, acts)):
-            if isinstance(conv_config, torch.Size):
+        for i, (conv_config, req, norm_type, act_type, stride) in enumerate(zip(convs, reqs, norms, acts, strides)):
+            if isinstance(conv_config, (tuple, list)):  # torch.Size 也是 tuple
                 conv_out_channels, conv_in_channels, *kernel_size = conv_config
                 weight = None
             elif isinstance(conv_config, torch.Tensor):
@@ -105,19 +113,24 @@ class DNet(nn.Module):
                 )
                 current_channels = conv_in_channels
 
-            padding = tuple(k // 2 for k in kernel_size)
-            conv = conv_layer(
-                conv_in_channels,
-                conv_out_channels,
-                kernel_size=kernel_size,
-                padding=padding,
-                bias=False,
-            )
-            if weight is not None:
-                conv.weight = nn.Parameter(weight, requires_grad=req)
+            if identity and weight is not None and not req and stride == 1 and self._is_identity_kernel(weight):
+                # 不可学习的 1x1 恒等卷积等价于直接传递特征，以 Identity 占位以省去卷积计算并保持层索引不变
+                layers.append(nn.Identity())
             else:
-                conv.weight.requires_grad = req
-            layers.append(conv)
+                padding = tuple(k // 2 for k in kernel_size)
+                conv = conv_layer(
+                    conv_in_channels,
+                    conv_out_channels,
+                    kernel_size=kernel_size,
+                    stride=stride,
+                    padding=padding,
+                    bias=False,
+                )
+                if weight is not None:
+                    conv.weight = nn.Parameter(weight, requires_grad=req)
+                else:
+                    conv.weight.requires_grad = req
+                layers.append(conv)
             current_channels = conv_out_channels
 
             if norm_type:
@@ -144,6 +157,15 @@ class DNet(nn.Module):
             )
 
         self.filter = nn.Sequential(*layers)
+        self.use_checkpoint = False
+
+    @staticmethod
+    def _is_identity_kernel(weight: torch.Tensor) -> bool:
+        """判断卷积核是否为 1x1 恒等映射（输出通道 i 仅复制输入通道 i）。"""
+        out_channels, in_channels, *kernel_size = weight.shape
+        if out_channels != in_channels or any(k != 1 for k in kernel_size):
+            return False
+        return torch.equal(weight.detach().reshape(out_channels, in_channels).cpu(), torch.eye(out_channels, dtype=weight.dtype))
 
     def add_channel_adjustment_conv(self, conv_layer, in_channels: int, out_channels: int) -> nn.Module:
         return conv_layer(
@@ -153,9 +175,76 @@ class DNet(nn.Module):
             bias=True,
         )
 
+    def fuse_conv_bn(self):
+        """将卷积与其后的 BatchNorm 融合为单个卷积（仅用于推理），BatchNorm 位置替换为 Identity 以保持层索引不变。"""
+        for i in range(len(self.filter) - 1):
+            conv, norm = self.filter[i], self.filter[i + 1]
+            if isinstance(conv, nn.modules.conv._ConvNd) and isinstance(norm, nn.modules.batchnorm._BatchNorm):
+                self.filter[i] = fuse_conv_bn_eval(conv.eval(), norm.eval())
+                self.filter[i + 1] = nn.Identity()
+
+    @staticmethod
+    def _run_segment(x: torch.Tensor, layers: List[nn.Module]) -> torch.Tensor:
+        for layer in layers:
+            x = layer(x)
+        return x
+
+    def _checkpointed_filter(self, x: torch.Tensor) -> torch.Tensor:
+        """分段执行 filter：以卷积开头的段在检查点内重算；BatchNorm 及其后直到下一个卷积的层在检查点外执行，
+        避免反向重算时重复更新 BatchNorm 的运行统计量，也避免原地激活修改检查点输入。"""
+        segment = []
+        eager = False
+        for layer in self.filter:
+            if isinstance(layer, nn.modules.batchnorm._BatchNorm):
+                if segment:
+                    x = checkpoint(self._run_segment, x, segment, use_reentrant=False)
+                    segment = []
+                x = layer(x)
+                eager = True
+            elif isinstance(layer, nn.modules.conv._ConvNd) or not eager:
+                segment.append(layer)
+                eager = False
+            else:
+                x = layer(x)
+        if segment:
+            x = checkpoint(self._run_segment, x, segment, use_reentrant=False)
+        return x
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return self._checkpointed_filter(x)
         return self.filter(x)
 
+def fuse_conv_bn(model: nn.Module) -> nn.Module:
+    """将模型中所有 DNet 的 Conv+BatchNorm 融合（仅用于推理），减少逐层的内存读写。"""
+    model.eval()
+    for module in list(model.modules()):
+        if isinstance(module, DNet):
+            module.fuse_conv_bn()
+    return model
+
+def enable_checkpointing(model: nn.Module) -> nn.Module:
+    """为含空间卷积核（kernel > 1）的 DNet 开启梯度检查点，反向传播时重算卷积段的激活以节省显存（BatchNorm 在检查点外执行，运行统计量每步只更新一次）；1x1 卷积边开销小，保持不变。"""
+    for module in list(model.modules()):
+        if isinstance(module, DNet):
+            module.use_checkpoint = any(
+                isinstance(layer, nn.modules.conv._ConvNd) and any(k > 1 for k in layer.kernel_size)
+                for layer in module.filter
+            )
+    return model
+
+def compile_edges(model: nn.Module, mode: str = "default", sub_network_names: Optional[List[str]] = None) -> nn.Module:
+    """逐个编译模型中的 DNet（原地编译，state_dict 键名不变），节点路由保留在 Python 中执行；
+    给定 sub_network_names 时只编译 MHDNet 中这些子网络的 DNet。"""
+    if sub_network_names is None:
+        modules = list(model.modules())
+    else:
+        modules = [m for name in sub_network_names for m in model.sub_networks[name].modules()]
+    for module in modules:
+        if isinstance(module, DNet):
+            module.compile(mode=mode, dynamic=False)
+    return model
+
 class HDNet(nn.Module):
     """基于超边的网络，支持动态维度和灵活的节点连接。
 
@@ -179,9 +268,11 @@ class HDNet(nn.Module):
         self.in_edges = defaultdict(list)
         self.out_edges = defaultdict(list)
         self.node_order = []
+        self.edge_plan = {}
 
         self._build_hyperedges()
         self._topological_sort()
+        self._build_edge_plan()
 
     def _compute_edge_channels(self, src_nodes: List[str], dst_nodes: List[str]) -> Tuple[int, int]:
         in_channels = sum(self.node_configs[src][0] for src in src_nodes)
@@ -208,8 +299,10 @@ class HDNet(nn.Module):
                 reqs = params.get("reqs", [True] * len(convs))
                 norms = params.get("norms")
                 acts = params.get("acts")
+                strides = params.get("strides")
                 self.edges[edge_id] = DNet(
-                    in_channels, out_channels, self.num_dims, convs, reqs, norms, acts
+                    in_channels, out_channels, self.num_dims, convs, reqs, norms, acts, strides,
+                    identity=params.get("identity", False),
                 )
             else:
                 self.edges[edge_id] = dnet  # 直接使用传入的 DNet 实例
@@ -236,12 +329,13 @@ class HDNet(nn.Module):
         mode: str,
     ) -> torch.Tensor:
         if not target_size or x.shape[2:] == tuple(target_size):
-            return x.to(dtype=torch.float32)
+            return x
 
         mode = mode.lower()
         if mode in ("max", "avg"):
-            pool_layer = getattr(nn, f"Adaptive{mode.title()}Pool{self.num_dims}d")
-            return pool_layer(target_size)(x)
+            # 函数式池化，避免每次前向都新建池化模块
+            pool_fn = getattr(F, f"adaptive_{mode}_pool{self.num_dims}d")
+            return pool_fn(x, target_size)
         if mode in ("nearest", "linear"):
             return F.interpolate(
                 x,
@@ -279,8 +373,62 @@ class HDNet(nn.Module):
             raise ValueError("超图中存在环，无法进行拓扑排序")
         self.node_order = sorted_nodes
 
+    def _build_edge_plan(self):
+        """预先解析每条超边的静态参数，前向传播时不再逐次查询配置字典。"""
+        identity_order = tuple(range(self.num_dims + 2))
+        for edge_id, edge_config in self.hyperedge_configs.items():
+            src_nodes = edge_config.get("src_nodes", [])
+            dst_nodes = edge_config.get("dst_nodes", [])
+            params = edge_config.get("params", {})
+            feature_size = params.get("feature_size")
+            # 带步长的超边输出尺寸小于 feature_size，默认不做 reshape，由目标节点插值对齐
+            strided = any(stride > 1 for stride in params.get("strides") or [])
+            reshape_size = params.get("reshape", None if strided else feature_size)
+            permute_order = tuple(params.get("permute", identity_order))
+            self.edge_plan[edge_id] = {
+                "src_nodes": src_nodes,
+                "dst_nodes": dst_nodes,
+                "feature_size": feature_size,
+                "intp": params.get("intp", "linear"),
+                "reshape_size": tuple(reshape_size) if reshape_size else None,
+                "permute_order": permute_order if permute_order != identity_order else None,
+                "channel_sizes": [self.node_configs[dst][0] for dst in dst_nodes],
+                "dst_sizes": [self.node_configs[dst][1:] for dst in dst_nodes],
+            }
+
+    def _run_edge(self, edge_id: str, features: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        plan = self.edge_plan[edge_id]
+        src_nodes = plan["src_nodes"]
+        if not all(src in features for src in src_nodes):
+            raise ValueError(f"超边 {edge_id} 的源节点 {src_nodes} 中某些节点未准备好")
+
+        src_features = [
+            self._interpolate(features[src], plan["feature_size"], plan["intp"])
+            for src in src_nodes
+        ]
+        input_feat = torch.cat(src_features, dim=1)
+        output = self.edges[edge_id](input_feat)
+
+        if edge_id in self.dropouts:
+            output = self.dropouts[edge_id](output)
+
+        reshape_size = plan["reshape_size"]
+        if reshape_size and output.shape[2:] != reshape_size:
+            output = output.reshape(-1, output.shape[1], *reshape_size)
+
+        if plan["permute_order"] is not None:
+            output = output.permute(*plan["permute_order"])
+
+        split_outputs = torch.split(output, plan["channel_sizes"], dim=1)
+        return {
+            dst: self._interpolate(feat, dst_size, plan["intp"])
+            for dst, dst_size, feat in zip(plan["dst_nodes"], plan["dst_sizes"], split_outputs)
+        }
+
     def forward(self, inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         features = {node: tensor.to(dtype=torch.float32) for node, tensor in inputs.items()}
+        # 每条超边在一次前向中只计算一次，多个目标节点共享其输出
+        edge_outputs = {}
         for node in self.node_order:
             if node in features:
                 continue
@@ -291,47 +439,17 @@ class HDNet(nn.Module):
 
             node_inputs = []
             for edge_id in in_edge_ids:
-                edge_config = self.hyperedge_configs[edge_id]
-                src_nodes = edge_config.get("src_nodes", [])
-                dst_nodes = edge_config.get("dst_nodes", [])
-                params = edge_config.get("params", {})
-                feature_size = params.get("feature_size")
-                intp = params.get("intp", "linear")
-                reshape_size = params.get("reshape", feature_size)
-                permute_order = params.get("permute", tuple(range(self.num_dims + 2)))
-
-                if not all(src in features for src in src_nodes):
-                    raise ValueError(f"超边 {edge_id} 的源节点 {src_nodes} 中某些节点未准备好")
-
-                src_features = [
-                    self._interpolate(features[src], feature_size, intp)
-                    for src in src_nodes
-                ]
-                input_feat = torch.cat(src_features, dim=1)
-                output = self.edges[edge_id](input_feat)
-
-                if edge_id in self.dropouts:
-                    output = self.dropouts[edge_id](output)
-
-                if reshape_size and output.shape[2:] != tuple(reshape_size):
-                    output = output.reshape(-1, output.shape[1], *reshape_size)
-
-                if permute_order != tuple(range(self.num_dims + 2)):
-                    output = output.permute(*permute_order)
-
-                channel_sizes = [self.node_configs[dst][0] for dst in dst_nodes]
-                split_outputs = torch.split(output, channel_sizes, dim=1)
-                dst_features = {
-                    dst: self._interpolate(feat, self.node_configs[dst][1:], intp)
-                    for dst, feat in zip(dst_nodes, split_outputs)
-                }
+                if edge_id not in edge_outputs:
+                    edge_outputs[edge_id] = self._run_edge(edge_id, features)
+                dst_features = edge_outputs[edge_id]
 
                 if node in dst_features:
                     node_inputs.append(dst_features[node])
 
             if not node_inputs:
                 raise ValueError(f"节点 {node} 没有有效输入")
-            features[node] = sum(node_inputs).to(dtype=torch.float32)
+            # 不强制转回 float32：autocast 下中间特征（含跳跃连接）以半精度保存，输出由调用方转换
+            features[node] = sum(node_inputs)
 
         return features
 
@@ -365,7 +483,7 @@ class MHDNet(nn.Module):
 
         self._build_global_graph()
         if onnx_save_path:
-            self._export_to_onnx(onnx_save_path)
+            self.export_onnx(onnx_save_path)
 
     def _build_global_graph(self):
         global_node_configs = {}
@@ -376,6 +494,8 @@ class MHDNet(nn.Module):
         for g_node, sub_net, sub_node in self.node_mapping:
             global_to_sub[g_node].append((sub_net, sub_node))
             global_node_configs[g_node] = self.sub_networks[sub_net].node_configs[sub_node]
+            # 子网络节点到全局节点的查找表，避免逐边线性扫描 node_mapping
+            sub_to_global.setdefault((sub_net, sub_node), g_node)
 
         for g_node, mappings in global_to_sub.items():
             shapes = [self.sub_networks[sub_net].node_configs[sub_node] for sub_net, sub_node in mappings]
@@ -385,7 +505,7 @@ class MHDNet(nn.Module):
         edge_id_counter = 0
         for sub_net_name, sub_net in self.sub_networks.items():
             for sub_node in sub_net.node_configs:
-                if not any(sub_net_name == sn and sub_node == snode for _, sn, snode in self.node_mapping):
+                if (sub_net_name, sub_node) not in sub_to_global:
                     global_node = f"{sub_net_name}_{sub_node}"
                     sub_to_global[(sub_net_name, sub_node)] = global_node
                     global_node_configs[global_node] = sub_net.node_configs[sub_node]
@@ -397,27 +517,8 @@ class MHDNet(nn.Module):
                 dst_nodes = edge_config.get("dst_nodes", [])
                 params = edge_config.get("params", {})
 
-                global_src_nodes = []
-                for src in src_nodes:
-                    found = False
-                    for g_node, sn, snode in self.node_mapping:
-                        if sn == sub_net_name and snode == src:
-                            global_src_nodes.append(g_node)
-                            found = True
-                            break
-                    if not found:
-                        global_src_nodes.append(sub_to_global[(sub_net_name, src)])
-
-                global_dst_nodes = []
-                for dst in dst_nodes:
-                    found = False
-                    for g_node, sn, snode in self.node_mapping:
-                        if sn == sub_net_name and snode == dst:
-                            global_dst_nodes.append(g_node)
-                            found = True
-                            break
-                    if not found:
-                        global_dst_nodes.append(sub_to_global[(sub_net_name, dst)])
+                global_src_nodes = [sub_to_global[(sub_net_name, src)] for src in src_nodes]
+                global_dst_nodes = [sub_to_global[(sub_net_name, dst)] for dst in dst_nodes]
 
                 # 直接引用子网络的 DNet 实例
                 global_hyperedge_configs[global_edge_id] = {
@@ -433,7 +534,10 @@ class MHDNet(nn.Module):
             num_dimensions=self.num_dims,
         )
 
-    def _export_to_onnx(self, onnx_save_path: str):
+    def export_onnx(self, onnx_save_path: str):
+        """导出为 ONNX 模型；示例输入创建在参数所在设备上，导出后恢复原来的训练/评估模式。"""
+        was_training = self.training
+        device = next(self.parameters()).device
         self.eval()
         input_shapes = []
         seen_global_nodes = set()
@@ -442,7 +546,7 @@ class MHDNet(nn.Module):
                 input_shapes.append((1, *self.global_net.node_configs[global_node]))
                 seen_global_nodes.add(global_node)
 
-        inputs = [torch.randn(*shape) for shape in input_shapes]
+        inputs = [torch.randn(*shape, device=device) for shape in input_shapes]
         dynamic_axes = {
             **{f"input_{node}": {0: "batch_size"} for node in self.in_nodes},
             **{f"output_{node}": {0: "batch_size"} for node in self.out_nodes},
@@ -460,6 +564,7 @@ class MHDNet(nn.Module):
             do_constant_folding=False,
             opset_version=17,
         )
+        self.train(was_training)
         print(f"模型已导出为 {onnx_save_path}")
 
     def forward(self, inputs: List[torch.Tensor]) -> List[torch.Tensor]:
@@ -16,6 +16,7 @@ Institution: Tsinghua University (清华大学)
 """
 
 import torch
+import torch.nn.functional as F
 import logging
 
 logger = logging.getLogger(__name__)
@@ -54,6 +55,21 @@ def get_valid_classes(target_tensor, num_classes):
         logger.error(f"Error in get_valid_classes: {str(e)}")
         return torch.tensor([], dtype=torch.int64, device=target_tensor.device), torch.zeros(num_classes, device=target_tensor.device)
 
+# Cache of class-weight tensors keyed by (weights, device), so list configs are converted once
+_alpha_cache = {}
+
+def get_alpha_tensor(alpha, device):
+    """
+    Return alpha as a float32 tensor on device, converting list/tuple configs only once.
+    将 alpha 转为设备上的 float32 张量，列表/元组配置仅转换一次。
+    """
+    if isinstance(alpha, torch.Tensor):
+        return alpha.to(device=device, dtype=torch.float32)
+    key = (tuple(float(a) for a in alpha), str(device))
+    if key not in _alpha_cache:
+        _alpha_cache[key] = torch.tensor(key[0], dtype=torch.float32, device=device)
+    return _alpha_cache[key]
+
 def node_lp_loss(src_tensor, target_tensor, p=1.0):
     """
     L-p loss for regression tasks.
@@ -72,10 +88,12 @@ def node_lp_loss(src_tensor, target_tensor, p=1.0):
         logger.error(f"Error in node_lp_loss: {str(e)}")
         return torch.tensor(0.0, device=src_tensor.device)
 
-def node_focal_loss(src_tensor, target_tensor, alpha=None, gamma=2.0):
+def node_focal_loss(src_tensor, target_tensor, alpha=None, gamma=2.0, from_logits=False):
     """
     Focal loss for classification tasks, handling class imbalance.
+    With from_logits=True, src_tensor holds raw logits and log_softmax is applied here instead of a softmax activation.
     分类任务的 Focal 损失，处理类别不平衡。
+    from_logits=True 时 src_tensor 为原始 logits，在此处使用 log_softmax，无需 softmax 激活层。
     """
     try:
         validate_one_hot(target_tensor, src_tensor.shape[1])
@@ -84,13 +102,18 @@ def node_focal_loss(src_tensor, target_tensor, alpha=None, gamma=2.0):
         num_classes = src_tensor.shape[1]
         valid_classes, _ = get_valid_classes(target_tensor, num_classes)
 
-        # Clip probabilities for numerical stability
-        pt = torch.clamp(src_tensor, min=1e-7, max=1-1e-7)
-        logpt = torch.log(pt)
-        loss = -target_tensor * (1 - pt) ** gamma * logpt
+        if from_logits:
+            logpt = F.log_softmax(src_tensor, dim=1)
+        else:
+            # Clip probabilities for numerical stability
+            logpt = torch.log(torch.clamp(src_tensor, min=1e-7, max=1-1e-7))
+        loss = -target_tensor * logpt
+        if gamma != 0:  # gamma=0 is plain weighted cross-entropy; skip pt and the all-ones modulating factor
+            pt = logpt.exp()
+            loss = loss * (1 - pt) ** gamma
 
         if alpha is not None:
-            alpha = torch.tensor(alpha, device=src_tensor.device)
+            alpha = get_alpha_tensor(alpha, src_tensor.device)
             if alpha.shape[0] != num_classes:
                 logger.error(f"Alpha shape {alpha.shape} does not match num_classes {num_classes}")
                 raise ValueError(f"Alpha must have length {num_classes}")
@@ -177,35 +200,48 @@ def node_mse_metric(src_tensor, target_tensor):
         logger.error(f"Error in node_mse_metric: {str(e)}")
         return {"per_class": [0.0], "avg": 0.0}
 
+def get_confusion_matrix(src_tensor, target_tensor):
+    """
+    Confusion matrix (rows: target, columns: prediction) of argmax predictions, with the valid classes and their counts.
+    Shared by the classification metrics so each computes a single bincount instead of per-class masks.
+    计算 argmax 预测的混淆矩阵（行：目标，列：预测），并返回有效类别及其样本数。
+    供各分类指标共用，每个指标只需一次 bincount，无需逐类别掩码。
+    """
+    validate_one_hot(target_tensor, src_tensor.shape[1])
+    num_classes = src_tensor.shape[1]
+    src_tensor = src_tensor.argmax(dim=1).flatten()
+    target_tensor = target_tensor.argmax(dim=1).flatten()
+    hist = torch.bincount(num_classes * target_tensor + src_tensor, minlength=num_classes**2)
+    hist = hist.reshape(num_classes, num_classes).float()
+    class_counts = hist.sum(dim=1)
+    valid_classes = torch.where(class_counts > 0)[0]
+    return hist, valid_classes, class_counts
+
+def weighted_class_metric(per_class, valid_classes, class_counts):
+    """
+    Report a per-class metric over the valid classes, averaged with weights proportional to class counts.
+    在有效类别上汇报逐类别指标，并按类别样本数加权求平均。
+    """
+    per_class = per_class[valid_classes]
+    avg = 0.0
+    if valid_classes.numel() > 0:
+        weights = class_counts[valid_classes] / class_counts[valid_classes].sum()
+        avg = (per_class * weights).sum().item()
+    return {
+        "per_class": per_class.tolist(),
+        "avg": avg
+    }
+
 def node_accuracy_metric(src_tensor, target_tensor):
     """
     Accuracy metric for classification tasks.
     分类任务的准确率指标。
     """
     try:
-        validate_one_hot(target_tensor, src_tensor.shape[1])
-        num_classes = src_tensor.shape[1]
-        valid_classes, class_counts = get_valid_classes(target_tensor, num_classes)
-        
-        src_tensor = src_tensor.argmax(dim=1).flatten()
-        target_tensor = target_tensor.argmax(dim=1).flatten()
-        
-        correct = (src_tensor == target_tensor).float()
-        
-        per_class_accuracy = torch.full((num_classes,), 0.0, device=src_tensor.device)
-        for c in valid_classes:
-            class_mask = (target_tensor == c)
-            per_class_accuracy[c] = correct[class_mask].mean().item()
-        
-        avg = 0.0
-        if valid_classes.numel() > 0:
-            weights = class_counts[valid_classes] / class_counts[valid_classes].sum()
-            avg = (per_class_accuracy[valid_classes] * weights).sum().item()
-        
-        return {
-            "per_class": per_class_accuracy[valid_classes].tolist(),
-            "avg": avg,
-        }
+        hist, valid_classes, class_counts = get_confusion_matrix(src_tensor, target_tensor)
+        # Fraction of each class's samples predicted correctly
+        accuracy = torch.diag(hist) / class_counts.clamp(min=1)
+        return weighted_class_metric(accuracy, valid_classes, class_counts)
     except Exception as e:
         logger.error(f"Error in node_accuracy_metric: {str(e)}")
         return {"per_class": [], "avg": 0.0}
@@ -216,34 +252,13 @@ def node_specificity_metric(src_tensor, target_tensor):
     分类任务的特异性指标。
     """
     try:
-        validate_one_hot(target_tensor, src_tensor.shape[1])
-        num_classes = src_tensor.shape[1]
-        valid_classes, class_counts = get_valid_classes(target_tensor, num_classes)
-        
-        src_tensor = src_tensor.argmax(dim=1).flatten()
-        target_tensor = target_tensor.argmax(dim=1).flatten()
-        
-        hist = torch.bincount(num_classes * target_tensor + src_tensor, minlength=num_classes**2)
-        hist = hist.reshape(num_classes, num_classes)
-        
+        hist, valid_classes, class_counts = get_confusion_matrix(src_tensor, target_tensor)
         TP = torch.diag(hist)
         FP = hist.sum(dim=0) - TP
         FN = hist.sum(dim=1) - TP
         TN = hist.sum() - (TP + FP + FN)
-        
-        specificity = torch.full((num_classes,), 0.0, device=src_tensor.device)
-        for c in valid_classes:
-            specificity[c] = TN[c] / (TN[c] + FP[c] + 1e-7)
-        
-        avg = 0.0
-        if valid_classes.numel() > 0:
-            weights = class_counts[valid_classes] / class_counts[valid_classes].sum()
-            avg = (specificity[valid_classes] * weights).sum().item()
-        
-        return {
-            "per_class": specificity[valid_classes].tolist(),
-            "avg": avg
-        }
+        specificity = TN / (TN + FP + 1e-7)
+        return weighted_class_metric(specificity, valid_classes, class_counts)
     except Exception as e:
         logger.error(f"Error in node_specificity_metric: {str(e)}")
         return {"per_class": [], "avg": 0.0}
@@ -254,32 +269,11 @@ def node_recall_metric(src_tensor, target_tensor):
     分类任务的召回率指标。
     """
     try:
-        validate_one_hot(target_tensor, src_tensor.shape[1])
-        num_classes = src_tensor.shape[1]
-        valid_classes, class_counts = get_valid_classes(target_tensor, num_classes)
-        
-        src_tensor = src_tensor.argmax(dim=1).flatten()
-        target_tensor = target_tensor.argmax(dim=1).flatten()
-        
-        hist = torch.bincount(num_classes * target_tensor + src_tensor, minlength=num_classes**2)
-        hist = hist.reshape(num_classes, num_classes)
-        
+        hist, valid_classes, class_counts = get_confusion_matrix(src_tensor, target_tensor)
         TP = torch.diag(hist)
         FN = hist.sum(dim=1) - TP
-        
-        recall = torch.full((num_classes,), 0.0, device=src_tensor.device)
-        for c in valid_classes:
-            recall[c] = TP[c] / (TP[c] + FN[c] + 1e-7)
-        
-        avg = 0.0
-        if valid_classes.numel() > 0:
-            weights = class_counts[valid_classes] / class_counts[valid_classes].sum()
-            avg = (recall[valid_classes] * weights).sum().item()
-        
-        return {
-            "per_class": recall[valid_classes].tolist(),
-            "avg": avg
-        }
+        recall = TP / (TP + FN + 1e-7)
+        return weighted_class_metric(recall, valid_classes, class_counts)
     except Exception as e:
         logger.error(f"Error in node_recall_metric: {str(e)}")
         return {"per_class": [], "avg": 0.0}
@@ -290,32 +284,11 @@ def node_precision_metric(src_tensor, target_tensor):
     分类任务的精确率指标。
     """
     try:
-        validate_one_hot(target_tensor, src_tensor.shape[1])
-        num_classes = src_tensor.shape[1]
-        valid_classes, class_counts = get_valid_classes(target_tensor, num_classes)
-        
-        src_tensor = src_tensor.argmax(dim=1).flatten()
-        target_tensor = target_tensor.argmax(dim=1).flatten()
-        
-        hist = torch.bincount(num_classes * target_tensor + src_tensor, minlength=num_classes**2)
-        hist = hist.reshape(num_classes, num_classes)
-        
+        hist, valid_classes, class_counts = get_confusion_matrix(src_tensor, target_tensor)
         TP = torch.diag(hist)
         FP = hist.sum(dim=0) - TP
-        
-        precision = torch.full((num_classes,), 0.0, device=src_tensor.device)
-        for c in valid_classes:
-            precision[c] = TP[c] / (TP[c] + FP[c] + 1e-7)
-        
-        avg = 0.0
-        if valid_classes.numel() > 0:
-            weights = class_counts[valid_classes] / class_counts[valid_classes].sum()
-            avg = (precision[valid_classes] * weights).sum().item()
-        
-        return {
-            "per_class": precision[valid_classes].tolist(),
-            "avg": avg
-        }
+        precision = TP / (TP + FP + 1e-7)
+        return weighted_class_metric(precision, valid_classes, class_counts)
     except Exception as e:
         logger.error(f"Error in node_precision_metric: {str(e)}")
         return {"per_class": [], "avg": 0.0}
@@ -326,25 +299,13 @@ def node_f1_metric(src_tensor, target_tensor):
     分类任务的 F1 分数指标。
     """
     try:
-        recall = torch.tensor(node_recall_metric(src_tensor, target_tensor)["per_class"], device=src_tensor.device)
-        precision = torch.tensor(node_precision_metric(src_tensor, target_tensor)["per_class"], device=src_tensor.device)
-        num_classes = src_tensor.shape[1]
-        valid_classes, class_counts = get_valid_classes(target_tensor, num_classes)
-        
-        f1 = torch.zeros(len(valid_classes), device=src_tensor.device)
-        for i, c in enumerate(valid_classes):
-            p, r = precision[i], recall[i]
-            f1[i] = 2 * p * r / (p + r + 1e-7)
-        
-        avg = 0.0
-        if valid_classes.numel() > 0:
-            weights = class_counts[valid_classes] / class_counts[valid_classes].sum()
-            avg = (f1 * weights).sum().item()
-        
-        return {
-            "per_class": f1.tolist(),
-            "avg": avg
-        }
+        # Recall and precision come from one confusion matrix rather than two separate metric calls
+        hist, valid_classes, class_counts = get_confusion_matrix(src_tensor, target_tensor)
+        TP = torch.diag(hist)
+        recall = TP / (hist.sum(dim=1) + 1e-7)
+        precision = TP / (hist.sum(dim=0) + 1e-7)
+        f1 = 2 * precision * recall / (precision + recall + 1e-7)
+        return weighted_class_metric(f1, valid_classes, class_counts)
     except Exception as e:
         logger.error(f"Error in node_f1_metric: {str(e)}")
         return {"per_class": [], "avg": 0.0}
@@ -21,13 +21,127 @@ import numpy as np
 from tabulate import tabulate
 import logging
 from collections import Counter
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+AMP_DTYPES = {
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+def autocast_context(precision="fp32"):
+    """
+    Return the autocast context for the given precision ("fp32", "fp16" or "bf16").
+    返回给定精度（"fp32"、"fp16" 或 "bf16"）对应的自动混合精度上下文。
+    """
+    if precision == "fp32" or device.type != "cuda":
+        return nullcontext()
+    if precision not in AMP_DTYPES:
+        raise ValueError(f"Invalid precision: {precision}. Choose 'fp32', 'fp16', or 'bf16'.")
+    return torch.autocast(device_type="cuda", dtype=AMP_DTYPES[precision])
+
+CHANNELS_LAST_FORMATS = {
+    4: torch.channels_last,
+    5: torch.channels_last_3d,
+}
+
+def to_device(tensor, channels_last=False, non_blocking=True):
+    """
+    Move a batch tensor to the device, optionally in channels-last layout for 2D/3D convolutions.
+    Copies are non-blocking so that transfers from pinned memory overlap with compute.
+    将批次张量移动到设备上，可选地为 2D/3D 卷积使用 channels-last 内存布局。
+    使用非阻塞拷贝，使锁页内存的传输与计算重叠。
+    """
+    if channels_last and tensor.dim() in CHANNELS_LAST_FORMATS:
+        return tensor.to(device, non_blocking=non_blocking, memory_format=CHANNELS_LAST_FORMATS[tensor.dim()])
+    return tensor.to(device, non_blocking=non_blocking)
+
+def prepare_inputs(batch, channels_last=False):
+    """
+    Move a {node: tensor} batch from MultiNodeDataset to the device as an input list in node order.
+    NodeDataset already returns float32 tensors, so each node is a single copy with no on-device cast.
+    将 MultiNodeDataset 的 {节点: 张量} 批次按节点顺序移动到设备上，组成输入列表。
+    NodeDataset 已返回 float32 张量，每个节点只需一次拷贝，无需在设备上再转换类型。
+    """
+    return [to_device(batch_data, channels_last) for batch_data in batch.values()]
+
+class CUDAPrefetcher:
+    """
+    Iterate a MultiNodeDataset dataloader, copying the next batch to the GPU on a side CUDA stream
+    while the current batch is being processed. Yields input lists as returned by prepare_inputs.
+    Falls back to synchronous prepare_inputs when running on CPU.
+    遍历 MultiNodeDataset 数据加载器，在处理当前批次时于独立 CUDA 流上将下一批次复制到 GPU。
+    产出与 prepare_inputs 相同的输入列表；在 CPU 上运行时退化为同步的 prepare_inputs。
+    """
+    def __init__(self, dataloader, channels_last=False):
+        self.dataloader = dataloader
+        self.channels_last = channels_last
+        self.stream = torch.cuda.Stream() if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _preload(self, loader_iter):
+        batch = next(loader_iter, None)
+        if batch is None:
+            return None
+        if self.stream is None:
+            return prepare_inputs(batch, self.channels_last)
+        with torch.cuda.stream(self.stream):
+            return prepare_inputs(batch, self.channels_last)
+
+    def __iter__(self):
+        loader_iter = iter(self.dataloader)
+        next_inputs = self._preload(loader_iter)
+        while next_inputs is not None:
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream()
+                current_stream.wait_stream(self.stream)
+                for tensor in next_inputs:
+                    tensor.record_stream(current_stream)
+            inputs_list = next_inputs
+            next_inputs = self._preload(loader_iter)
+            yield inputs_list
+
+class EpochBuffer:
+    """
+    Preallocated buffer collecting per-batch tensors along dim 0 over one epoch, replacing list append + torch.cat.
+    Storage is allocated on the first append with room for capacity rows; tensor() returns the filled rows.
+    GPU batches are copied asynchronously into pinned host memory, so the epoch's outputs do not occupy GPU memory.
+    在一个 epoch 内沿第 0 维收集各批次张量的预分配缓冲区，替代列表追加 + torch.cat。
+    首次追加时按 capacity 行分配存储；tensor() 返回已填充的行。
+    GPU 批次以异步方式拷贝到锁页主机内存，整个 epoch 的输出不再占用显存。
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = None
+        self.size = 0
+
+    def append(self, tensor):
+        if self.data is None:
+            pinned = tensor.device.type == "cuda"
+            self.data = torch.empty((self.capacity, *tensor.shape[1:]), dtype=tensor.dtype, device="cpu" if pinned else tensor.device, pin_memory=pinned)
+        rows = tensor.shape[0]
+        self.data[self.size:self.size + rows].copy_(tensor, non_blocking=True)
+        self.size += rows
+
+    def tensor(self):
+        if self.data is not None and self.data.is_pinned():
+            torch.cuda.current_stream().synchronize()  # Wait for pending device-to-host copies
+        return self.data[:self.size]
+
 class CosineAnnealingLR(optim.lr_scheduler.CosineAnnealingLR):
     """
     Cosine annealing learning rate scheduler.
@@ -62,239 +176,176 @@ class ReduceLROnPlateau(optim.lr_scheduler.ReduceLROnPlateau):
     def __init__(self, optimizer, factor=0.5, patience=10, eta_min=0, verbose=True, mode='min'):
         super().__init__(optimizer, mode=mode, factor=factor, patience=patience, min_lr=eta_min, verbose=verbose)
 
-def train(model, dataloaders, optimizer, task_configs, out_nodes, epoch, num_epochs, debug=False):
-    model.train()
-    running_loss = 0.0
-    # Temporary storage for per-batch losses to compute average at epoch end
-    temp_task_losses = {
-        task: {
-            (loss_cfg["fn"].__name__, str(loss_cfg["origin_node"]), str(loss_cfg["target_node"])): []
-            for loss_cfg in task_configs[task]["loss"]
-        }
-        for task in task_configs
-    }
-    task_metrics = {task: {} for task in task_configs}
-    all_preds = {task: [] for task in task_configs}
-    all_targets = {task: [] for task in task_configs}
-    class_distributions = {task: [] for task in task_configs}
-    case_ids_per_batch = []
-
-    data_iterators = {str(node): iter(dataloader) for node, dataloader in dataloaders.items()}
-    num_batches = len(next(iter(data_iterators.values())))
-
-    for batch_idx in range(num_batches):
-        optimizer.zero_grad()
-        inputs_list = []
-        batch_case_ids = []
-        
-        for node in dataloaders:
-            dataset = dataloaders[node].dataset
-            batch_data = next(data_iterators[str(node)])
-            data = batch_data.to(device)
-            start_idx = batch_idx * dataloaders[node].batch_size
-            end_idx = min((batch_idx + 1) * dataloaders[node].batch_size, len(dataset))
-            current_case_ids = dataset.case_ids[start_idx:end_idx]
-            batch_case_ids.append(current_case_ids)
-            
-            if data.dtype != torch.float32:
-                if debug:
-                    logger.info(f"Converting node {node} data from {data.dtype} to torch.float32")
-                data = data.to(dtype=torch.float32)
-            inputs_list.append(data)
-        
-        batch_case_ids_ref = batch_case_ids[0]
-        if not all(cids == batch_case_ids_ref for cids in batch_case_ids):
-            logger.warning(f"Batch {batch_idx} case IDs inconsistent across nodes: {batch_case_ids}")
-        case_ids_per_batch.append(batch_case_ids_ref)
-        
-        outputs = model(inputs_list)
-        total_loss = torch.tensor(0.0, device=device)
-
-        for task, config in task_configs.items():
-            task_loss = torch.tensor(0.0, device=device)
-            origin_node = str(config["metric"][0]["origin_node"]) if config.get("metric") else None
-            target_node = str(config["metric"][0]["target_node"]) if config.get("metric") else None
-            if origin_node and target_node:
-                origin_idx = out_nodes.index(origin_node)
-                target_idx = out_nodes.index(target_node)
-                all_preds[task].append(outputs[origin_idx].detach())
-                all_targets[task].append(outputs[target_idx].detach())
-                
-            target_idx = out_nodes.index(str(config["loss"][0]["target_node"]))
-            target_tensor = outputs[target_idx]
-            class_indices = torch.argmax(target_tensor, dim=1).flatten().cpu().numpy()
-            class_counts = Counter(class_indices)
-            class_distributions[task].append(class_counts)
-            
-            for loss_cfg in config["loss"]:
-                fn = loss_cfg["fn"]
-                origin_node = str(loss_cfg["origin_node"])
-                target_node = str(loss_cfg["target_node"])
-                weight = loss_cfg["weight"]
-                params = loss_cfg["params"]
-                origin_idx = out_nodes.index(origin_node)
-                target_idx = out_nodes.index(target_node)
-                loss = fn(outputs[origin_idx], outputs[target_idx], **params)
-                task_loss += weight * loss
-                temp_task_losses[task][(fn.__name__, origin_node, target_node)].append(loss.item())
-            total_loss += task_loss
-
-        total_loss.backward()
-        # torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-        optimizer.step()
-        running_loss += total_loss.item()
-
-        del inputs_list, outputs, total_loss, task_loss
-        torch.cuda.empty_cache()
-
-    avg_loss = running_loss / num_batches
-    # Compute final task_losses with averaged values
-    task_losses = {
-        task: {
-            loss_cfg["fn"].__name__: {
-                "origin_node": str(loss_cfg["origin_node"]),
-                "target_node": str(loss_cfg["target_node"]),
-                "weight": loss_cfg["weight"],
-                "params": loss_cfg["params"],
-                "value": np.mean(temp_task_losses[task][(loss_cfg["fn"].__name__, str(loss_cfg["origin_node"]), str(loss_cfg["target_node"]))])
-            }
-            for loss_cfg in task_configs[task]["loss"]
+class AsyncCheckpointSaver:
+    """
+    Save state dicts on a background thread so checkpoint I/O overlaps with training.
+    - Tensors are copied to CPU on the calling thread, so later optimizer steps cannot alter the saved weights.
+    - Files are written to a temporary path and moved into place with os.replace, so a checkpoint is never half-written.
+    - save_all queues several files as one job, so a best-epoch checkpoint of all sub-networks costs a single hand-off.
+    在后台线程中保存 state dict，使检查点 I/O 与训练重叠。
+    - 张量在调用线程中复制到 CPU，后续优化器更新不会影响已保存的权重。
+    - 文件先写入临时路径再通过 os.replace 替换，避免检查点写入不完整。
+    - save_all 将多个文件作为一个任务排队，所有子网络的最佳检查点只需一次提交。
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    @staticmethod
+    def _write(state_dicts):
+        for save_path, state_dict in state_dicts.items():
+            tmp_path = save_path + ".tmp"
+            torch.save(state_dict, tmp_path)
+            os.replace(tmp_path, save_path)
+
+    def save(self, state_dict, save_path):
+        self.save_all({save_path: state_dict})
+
+    def save_all(self, state_dicts):
+        """
+        Queue several state dicts, given as {save_path: state_dict}, as one background job.
+        将多个 state dict（{save_path: state_dict}）作为一个后台任务排队保存。
+        """
+        # Surface errors from earlier saves and drop finished jobs
+        for future in [f for f in self.pending if f.done()]:
+            future.result()
+            self.pending.remove(future)
+        cpu_state_dicts = {
+            save_path: {k: v.detach().to("cpu", copy=True) for k, v in state_dict.items()}
+            for save_path, state_dict in state_dicts.items()
         }
-        for task in task_configs
-    }
-    task_losses_avg = {
-        task: sum(loss["value"] * loss["weight"] for loss in task_losses[task].values())
-        for task in task_configs
-    }
-
+        self.pending.append(self.executor.submit(self._write, cpu_state_dicts))
+
+    def close(self):
+        """
+        Wait for all queued saves to finish and shut down the worker thread.
+        等待所有排队的保存完成并关闭后台线程。
+        """
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        self.executor.shutdown(wait=True)
+
+def append_jsonl(path, record):
+    """
+    Append one record as a single JSON line, using orjson when it is installed.
+    - orjson also serializes NumPy scalars and arrays directly; NaN is written as null.
+    以单行 JSON 形式追加一条记录，安装了 orjson 时使用 orjson。
+    - orjson 可直接序列化 NumPy 标量和数组；NaN 写为 null。
+    """
+    if orjson is not None:
+        with open(path, "ab") as f:
+            f.write(orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n")
+    else:
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+def build_task_plans(task_configs, out_nodes):
+    """
+    Resolve each task's configs once into output indices, so the batch loop does no string or list lookups.
+    - "metric_indices": (origin_idx, target_idx) of the first metric, or None when the task has no metrics.
+    - "dist_index": output index of the first loss target, used for the class distribution.
+    - "losses": (fn, key, origin_idx, target_idx, weight, params) tuples; key is the (fn name, origin node, target node) logging key.
+    将每个任务的配置一次性解析为输出索引，使批次循环中不再进行字符串或列表查找。
+    - "metric_indices"：第一个指标的 (origin_idx, target_idx)，任务无指标时为 None。
+    - "dist_index"：第一个损失目标的输出索引，用于统计类别分布。
+    - "losses"：(fn, key, origin_idx, target_idx, weight, params) 元组；key 为 (函数名, 源节点, 目标节点) 记录键。
+    """
+    node_index = {str(node): idx for idx, node in enumerate(out_nodes)}
+    plans = {}
     for task, config in task_configs.items():
+        metric_indices = None
         if config.get("metric"):
-            origin_tensor = torch.cat(all_preds[task], dim=0)
-            target_tensor = torch.cat(all_targets[task], dim=0)
-            for metric_cfg in config["metric"]:
-                fn = metric_cfg["fn"]
-                origin_node = str(metric_cfg["origin_node"])
-                target_node = str(metric_cfg["target_node"])
-                params = metric_cfg["params"]
-                metric_value = fn(origin_tensor, target_tensor, **params)
-                task_metrics[task][fn.__name__] = {"origin_node": origin_node, "target_node": target_node, "value": metric_value}
-            del origin_tensor, target_tensor
-            torch.cuda.empty_cache()
-
-    print(f"Epoch [{epoch+1}/{num_epochs}], Train Total Loss: {avg_loss:.4f}")
-    for task, avg_task_loss in task_losses_avg.items():
-        print(f"Task: {task}, Avg Loss: {avg_task_loss:.4f}")
-        print(f"  Class Distribution for Task: {task}")
-        total_counts = Counter()
-        for batch_counts in class_distributions[task]:
-            total_counts.update(batch_counts)
-        dist_table = [[f"Class {cls}", count] for cls, count in sorted(total_counts.items())]
-        dist_headers = ["Class", "Count"]
-        print(tabulate(dist_table, headers=dist_headers, tablefmt="grid"))
+            metric_cfg = config["metric"][0]
+            metric_indices = (node_index[str(metric_cfg["origin_node"])], node_index[str(metric_cfg["target_node"])])
+        plans[task] = {
+            "metric_indices": metric_indices,
+            "dist_index": node_index[str(config["loss"][0]["target_node"])],
+            "losses": [
+                (
+                    loss_cfg["fn"],
+                    (loss_cfg["fn"].__name__, str(loss_cfg["origin_node"]), str(loss_cfg["target_node"])),
+                    node_index[str(loss_cfg["origin_node"])],
+                    node_index[str(loss_cfg["target_node"])],
+                    loss_cfg["weight"],
+                    loss_cfg["params"],
+                )
+                for loss_cfg in config["loss"]
+            ],
+        }
+    return plans
 
-        for fn_name, loss in task_losses[task].items():
-            origin_node = loss["origin_node"]
-            target_node = loss["target_node"]
-            weight = loss["weight"]
-            params_str = ", ".join(f"{k}={v}" for k, v in loss["params"].items())
-            avg_loss_value = loss["value"]
-            print(f"  Loss: {fn_name}({origin_node}, {target_node}), Weight: {weight:.2f}, Params: {params_str}, Value: {avg_loss_value:.4f}")
+def _run_epoch(model, dataloader, task_configs, out_nodes, epoch, num_epochs, optimizer=None, scaler=None, precision="fp32", channels_last=False, accumulation_steps=1):
+    """
+    Shared epoch loop behind train and validate; trains when optimizer is given, otherwise evaluates under torch.inference_mode().
 
-        for fn_name, metric in task_metrics[task].items():
-            origin_node = str(metric["origin_node"])
-            target_node = str(metric["target_node"])
-            metric_value = metric["value"]
-            valid_classes = sorted(total_counts.keys())
-            headers = ["Class", fn_name.split("_")[1].capitalize()]
-            table = [[f"Class {valid_classes[i]}", f"{v:.4f}" if not np.isnan(v) else "N/A"] for i, v in enumerate(metric_value["per_class"])] + [["Avg", f"{metric_value['avg']:.4f}" if not np.isnan(metric_value['avg']) else "N/A"]]
-            print(f"  Metric: {fn_name}({origin_node}, {target_node})")
-            print(tabulate(table, headers=headers, tablefmt="grid"))
+    train 与 validate 共用的单轮循环；提供 optimizer 时训练，否则在 torch.inference_mode() 下评估。
+    """
+    training = optimizer is not None
+    model.train(training)
+    running_loss = torch.zeros((), device=device)  # Accumulated on device; read back once per epoch
+    # Running per-loss sums kept on device and averaged at epoch end, avoiding a host sync per loss
+    task_plans = build_task_plans(task_configs, out_nodes)
+    loss_sums = {task: {key: torch.zeros((), device=device) for _, key, *_ in plan["losses"]} for task, plan in task_plans.items()}
+    task_metrics = {task: {} for task in task_configs}
+    all_preds = {task: EpochBuffer(len(dataloader.dataset)) for task in task_configs}
+    # Targets and class counts are keyed by output index, so tasks sharing a target node store and count it once
+    all_targets = {
+        plan["metric_indices"][1]: EpochBuffer(len(dataloader.dataset))
+        for plan in task_plans.values() if plan["metric_indices"] is not None
+    }
+    class_distributions = {plan["dist_index"]: None for plan in task_plans.values()}  # Accumulated on device
 
-    return avg_loss, task_losses, task_metrics
+    num_batches = len(dataloader)
 
-def validate(model, dataloaders, task_configs, out_nodes, epoch, num_epochs, debug=False):
-    model.eval()
-    running_loss = 0.0
-    # Temporary storage for per-batch losses to compute average at epoch end
-    temp_task_losses = {
-        task: {
-            (loss_cfg["fn"].__name__, str(loss_cfg["origin_node"]), str(loss_cfg["target_node"])): []
-            for loss_cfg in task_configs[task]["loss"]
-        }
-        for task in task_configs
-    }
-    task_metrics = {task: {} for task in task_configs}
-    all_preds = {task: [] for task in task_configs}
-    all_targets = {task: [] for task in task_configs}
-    class_distributions = {task: [] for task in task_configs}
-    case_ids_per_batch = []
-
-    with torch.no_grad():
-        data_iterators = {str(node): iter(dataloader) for node, dataloader in dataloaders.items()}
-        num_batches = len(next(iter(data_iterators.values())))
-
-        for batch_idx in range(num_batches):
-            inputs_list = []
-            batch_case_ids = []
-            
-            for node in dataloaders:
-                dataset = dataloaders[node].dataset
-                batch_data = next(data_iterators[str(node)])
-                data = batch_data.to(device)
-                start_idx = batch_idx * dataloaders[node].batch_size
-                end_idx = min((batch_idx + 1) * dataloaders[node].batch_size, len(dataset))
-                current_case_ids = dataset.case_ids[start_idx:end_idx]
-                batch_case_ids.append(current_case_ids)
-                
-                if data.dtype != torch.float32:
-                    if debug:
-                        logger.info(f"Converting node {node} data from {data.dtype} to torch.float32")
-                    data = data.to(dtype=torch.float32)
-                inputs_list.append(data)
-            
-            batch_case_ids_ref = batch_case_ids[0]
-            if not all(cids == batch_case_ids_ref for cids in batch_case_ids):
-                logger.warning(f"Batch {batch_idx} case IDs inconsistent across nodes: {batch_case_ids}")
-            case_ids_per_batch.append(batch_case_ids_ref)
-            
-            outputs = model(inputs_list)
+    if training:
+        optimizer.zero_grad(set_to_none=True)
+    with nullcontext() if training else torch.inference_mode():
+        for batch_idx, inputs_list in enumerate(CUDAPrefetcher(dataloader, channels_last)):
+            with autocast_context(precision):
+                outputs = model(inputs_list)
+            outputs = [output.float() for output in outputs]
             total_loss = torch.tensor(0.0, device=device)
 
-            for task, config in task_configs.items():
+            for target_idx, buffer in all_targets.items():
+                buffer.append(outputs[target_idx].detach())
+            for dist_index, counts in class_distributions.items():
+                target_tensor = outputs[dist_index]
+                class_counts = torch.bincount(torch.argmax(target_tensor, dim=1).flatten(), minlength=target_tensor.shape[1])
+                class_distributions[dist_index] = class_counts if counts is None else counts + class_counts
+
+            for task, plan in task_plans.items():
                 task_loss = torch.tensor(0.0, device=device)
-                origin_node = str(config["metric"][0]["origin_node"]) if config.get("metric") else None
-                target_node = str(config["metric"][0]["target_node"]) if config.get("metric") else None
-                if origin_node and target_node:
-                    origin_idx = out_nodes.index(origin_node)
-                    target_idx = out_nodes.index(target_node)
-                    all_preds[task].append(outputs[origin_idx].detach())
-                    all_targets[task].append(outputs[target_idx].detach())
-                
-                target_idx = out_nodes.index(str(config["loss"][0]["target_node"]))
-                target_tensor = outputs[target_idx]
-                class_indices = torch.argmax(target_tensor, dim=1).flatten().cpu().numpy()
-                class_counts = Counter(class_indices)
-                class_distributions[task].append(class_counts)
-                
-                for loss_cfg in config["loss"]:
-                    fn = loss_cfg["fn"]
-                    origin_node = str(loss_cfg["origin_node"])
-                    target_node = str(loss_cfg["target_node"])
-                    weight = loss_cfg["weight"]
-                    params = loss_cfg["params"]
-                    origin_idx = out_nodes.index(origin_node)
-                    target_idx = out_nodes.index(target_node)
+                if plan["metric_indices"] is not None:
+                    all_preds[task].append(outputs[plan["metric_indices"][0]].detach())
+
+                for fn, key, origin_idx, target_idx, weight, params in plan["losses"]:
                     loss = fn(outputs[origin_idx], outputs[target_idx], **params)
                     task_loss += weight * loss
-                    temp_task_losses[task][(fn.__name__, origin_node, target_node)].append(loss.item())
+                    loss_sums[task][key] += loss.detach()
                 total_loss += task_loss
 
-            running_loss += total_loss.item()
+            if training:
+                # Step once every accumulation_steps batches, and on the last batch of the epoch
+                step_now = (batch_idx + 1) % accumulation_steps == 0 or batch_idx + 1 == num_batches
+                if scaler is not None:
+                    scaler.scale(total_loss / accumulation_steps).backward()
+                    if step_now:
+                        # scaler.unscale_(optimizer); torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+                        scaler.step(optimizer)
+                        scaler.update()
+                        optimizer.zero_grad(set_to_none=True)
+                else:
+                    (total_loss / accumulation_steps).backward()
+                    if step_now:
+                        # torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+                        optimizer.step()
+                        optimizer.zero_grad(set_to_none=True)
+            running_loss += total_loss.detach()
 
             del inputs_list, outputs, total_loss, task_loss
-            torch.cuda.empty_cache()
 
-    avg_loss = running_loss / num_batches
+    avg_loss = running_loss.item() / num_batches
     # Compute final task_losses with averaged values
     task_losses = {
         task: {
@@ -303,7 +354,7 @@ def validate(model, dataloaders, task_configs, out_nodes, epoch, num_epochs, deb
                 "target_node": str(loss_cfg["target_node"]),
                 "weight": loss_cfg["weight"],
                 "params": loss_cfg["params"],
-                "value": np.mean(temp_task_losses[task][(loss_cfg["fn"].__name__, str(loss_cfg["origin_node"]), str(loss_cfg["target_node"]))])
+                "value": loss_sums[task][(loss_cfg["fn"].__name__, str(loss_cfg["origin_node"]), str(loss_cfg["target_node"]))].item() / num_batches
             }
             for loss_cfg in task_configs[task]["loss"]
         }
@@ -316,8 +367,8 @@ def validate(model, dataloaders, task_configs, out_nodes, epoch, num_epochs, deb
 
     for task, config in task_configs.items():
         if config.get("metric"):
-            origin_tensor = torch.cat(all_preds[task], dim=0)
-            target_tensor = torch.cat(all_targets[task], dim=0)
+            origin_tensor = all_preds[task].tensor().to(device)
+            target_tensor = all_targets[task_plans[task]["metric_indices"][1]].tensor().to(device)
             for metric_cfg in config["metric"]:
                 fn = metric_cfg["fn"]
                 origin_node = str(metric_cfg["origin_node"])
@@ -328,17 +379,18 @@ def validate(model, dataloaders, task_configs, out_nodes, epoch, num_epochs, deb
             del origin_tensor, target_tensor
             torch.cuda.empty_cache()
 
-    print(f"Epoch [{epoch+1}/{num_epochs}], Val Total Loss: {avg_loss:.4f}")
+    print(f"Epoch [{epoch+1}/{num_epochs}], {'Train' if training else 'Val'} Total Loss: {avg_loss:.4f}")
     for task, avg_task_loss in task_losses_avg.items():
         print(f"Task: {task}, Avg Loss: {avg_task_loss:.4f}")
         print(f"  Class Distribution for Task: {task}")
         total_counts = Counter()
-        for batch_counts in class_distributions[task]:
-            total_counts.update(batch_counts)
+        task_counts = class_distributions[task_plans[task]["dist_index"]]
+        if task_counts is not None:
+            total_counts.update({cls: count for cls, count in enumerate(task_counts.tolist()) if count > 0})
         dist_table = [[f"Class {cls}", count] for cls, count in sorted(total_counts.items())]
         dist_headers = ["Class", "Count"]
         print(tabulate(dist_table, headers=dist_headers, tablefmt="grid"))
-        
+
         for fn_name, loss in task_losses[task].items():
             origin_node = loss["origin_node"]
             target_node = loss["target_node"]
@@ -359,59 +411,73 @@ def validate(model, dataloaders, task_configs, out_nodes, epoch, num_epochs, deb
 
     return avg_loss, task_losses, task_metrics
 
-def test(model, dataloaders, out_nodes, save_node, save_dir, debug=False):
+def train(model, dataloader, optimizer, task_configs, out_nodes, epoch, num_epochs, debug=False, scaler=None, precision="fp32", channels_last=False, accumulation_steps=1):
+    """
+    Training function for one epoch over the multi-node dataloader (MultiNodeDataset batches).
+    - Runs the forward pass under autocast when precision is "fp16" or "bf16"; losses are computed in FP32.
+    - Uses scaler (torch.cuda.amp.GradScaler) for the backward pass and optimizer step if provided.
+    - Moves inputs in channels-last layout when channels_last is True, matching a channels-last model.
+    - Copies the next batch to the GPU on a side stream (CUDAPrefetcher) while the current batch runs.
+    - Accumulates gradients over accumulation_steps batches before each optimizer step (effective batch = batch_size * accumulation_steps).
+
+    单轮训练函数，遍历多节点数据加载器（MultiNodeDataset 批次）。
+    - 当精度为 "fp16" 或 "bf16" 时在自动混合精度下执行前向传播，损失以 FP32 计算。
+    - 若提供 scaler（torch.cuda.amp.GradScaler），则用于反向传播和优化器更新。
+    - 当 channels_last 为 True 时以 channels-last 布局移动输入，与 channels-last 模型保持一致。
+    - 在当前批次计算时通过独立 CUDA 流（CUDAPrefetcher）预先将下一批次复制到 GPU。
+    - 在 accumulation_steps 个批次上累积梯度后再更新优化器（等效批大小 = batch_size * accumulation_steps）。
+    """
+    return _run_epoch(model, dataloader, task_configs, out_nodes, epoch, num_epochs, optimizer=optimizer, scaler=scaler, precision=precision, channels_last=channels_last, accumulation_steps=accumulation_steps)
+
+def validate(model, dataloader, task_configs, out_nodes, epoch, num_epochs, debug=False, precision="fp32", channels_last=False):
+    """
+    Validation function for one epoch over the multi-node dataloader (MultiNodeDataset batches).
+    - Runs the forward pass under autocast when precision is "fp16" or "bf16"; losses are computed in FP32.
+    - Moves inputs in channels-last layout when channels_last is True.
+
+    单轮验证函数，遍历多节点数据加载器（MultiNodeDataset 批次）。
+    - 当精度为 "fp16" 或 "bf16" 时在自动混合精度下执行前向传播，损失以 FP32 计算。
+    - 当 channels_last 为 True 时以 channels-last 布局移动输入。
+    """
+    return _run_epoch(model, dataloader, task_configs, out_nodes, epoch, num_epochs, precision=precision, channels_last=channels_last)
+
+def test(model, dataloader, out_nodes, save_node, save_dir, debug=False, channels_last=False, precision="fp32"):
     """
     Testing function to generate and save predictions for specified nodes.
     - Processes data in batches, consistent with train and validate functions.
     - Saves predictions to specified files in save_dir.
     - Does not compute losses or metrics.
+    - Runs the forward pass under autocast when precision is "fp16" or "bf16"; predictions are saved in FP32.
 
     测试函数，用于生成并保存指定节点的预测结果。
     - 按批次处理数据，与 train 和 validate 函数保持一致。
     - 将预测结果保存到 save_dir 中的指定文件。
     - 不计算损失或指标。
+    - 当精度为 "fp16" 或 "bf16" 时在自动混合精度下执行前向传播，预测结果以 FP32 保存。
     """
     model.eval()
-    case_ids_per_batch = []
-
-    data_iterators = {str(node): iter(dataloader) for node, dataloader in dataloaders.items()}
-    num_batches = len(next(iter(data_iterators.values())))
-
-    with torch.no_grad():
-        for batch_idx in range(num_batches):
-            inputs_list = []
-            batch_case_ids = []
-
-            for node in dataloaders:
-                dataset = dataloaders[node].dataset
-                batch_data = next(data_iterators[str(node)])
-                data = batch_data.to(device)
-                start_idx = batch_idx * dataloaders[node].batch_size
-                end_idx = min((batch_idx + 1) * dataloaders[node].batch_size, len(dataset))
-                current_case_ids = dataset.case_ids[start_idx:end_idx]
-                batch_case_ids.append(current_case_ids)
-
-                if data.dtype != torch.float32:
-                    if debug:
-                        logger.info(f"Converting node {node} data from {data.dtype} to torch.float32")
-                    data = data.to(dtype=torch.float32)
-                inputs_list.append(data)
-
-            batch_case_ids_ref = batch_case_ids[0]
-            if not all(cids == batch_case_ids_ref for cids in batch_case_ids):
-                logger.warning(f"Batch {batch_idx} case IDs inconsistent across nodes: {batch_case_ids}")
-            case_ids_per_batch.append(batch_case_ids_ref)
-
-            outputs = model(inputs_list)
+
+    case_ids = dataloader.dataset.case_ids
+    batch_size = dataloader.batch_size
+    num_batches = len(dataloader)
+
+    save_indices = [(node, out_nodes.index(str(node)), filename) for node, filename in save_node]
+
+    with torch.inference_mode():
+        for batch_idx, inputs_list in enumerate(CUDAPrefetcher(dataloader, channels_last)):
+            batch_case_ids_ref = case_ids[batch_idx * batch_size:(batch_idx + 1) * batch_size]
+
+            with autocast_context(precision):
+                outputs = model(inputs_list)
+            outputs = [output.float() for output in outputs]
 
             # Save predictions for specified nodes
-            for node, filename in save_node:
-                node_idx = out_nodes.index(str(node))
+            for node, node_idx, filename in save_indices:
                 predictions = outputs[node_idx].detach().cpu().numpy()
                 for idx, case_id in enumerate(batch_case_ids_ref):
                     save_path = os.path.join(save_dir, f"case_{case_id}_{filename}")
                     np.save(save_path, predictions[idx])
-                    logger.debug(f"Saved prediction for node {node}, case {case_id} to {save_path}")
+                    logger.debug("Saved prediction for node %s, case %s to %s", node, case_id, save_path)
 
             # Clear intermediate tensors
             del inputs_list, outputs